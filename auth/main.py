@@ -6,11 +6,11 @@ from sqlalchemy.future import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import datetime, timedelta
 from fastapi import FastAPI, Depends, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, PlainTextResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.security import OAuth2PasswordBearer
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from database import Users, Wallets
+from database import Users, Wallets, render_pool_metrics
 from schemas.common import *
 from schemas import exception_handlers
 from schemas.RedisClient import RedisClient, CacheName
@@ -64,6 +64,11 @@ async def hash_password(password: str, salt: bytes) -> str:
 async def home():
     return RedirectResponse(url="/authentication/docs", status_code=302)
 
+# the database pool's counters, for Prometheus to scrape (see database/pool.py)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def pool_metrics():
+    return render_pool_metrics()
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 @app.get(
@@ -1,2 +1,9 @@
 from .database import create_db_and_tables
 from .models import *
+from .pool import (
+    database_url,
+    engine_for,
+    session_maker_for,
+    render_pool_metrics,
+    report_pools,
+)
@@ -1,9 +1,42 @@
+import os
+import time
+from sqlalchemy import text
 from .database import create_db_and_tables
+from .partitions import maintain_partitions
 from .models import *
 
+# seconds between making new transaction partitions and archiving old ones, 0 to only set the
+# database up and exit
+PARTITION_MAINTENANCE_INTERVAL = int(
+    os.getenv("PARTITION_MAINTENANCE_INTERVAL") or 3600
+)
+
+# how long the ids of settled legs are kept to catch a leg delivered again (see SettledLegs).
+# A leg is only delivered again if a settlement worker stopped between committing it and
+# acking it, so this only has to outlast the workers being down.
+SETTLED_LEG_RETENTION_DAYS = int(os.getenv("SETTLED_LEG_RETENTION_DAYS") or 7)
+
+
+def prune_settled_legs(engine):
+    with engine.begin() as connection:
+        pruned = connection.execute(
+            text(
+                "DELETE FROM settledlegs "
+                "WHERE settled_at < now() - make_interval(days => :days)"
+            ),
+            {"days": SETTLED_LEG_RETENTION_DAYS},
+        ).rowcount
+    if pruned:
+        print(f"settledlegs: pruned {pruned} ids", flush=True)
+
 
 def main():
-    create_db_and_tables()
+    engine = create_db_and_tables()
+
+    while PARTITION_MAINTENANCE_INTERVAL:
+        time.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        maintain_partitions(engine)
+        prune_settled_legs(engine)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import os
 import dotenv
+from sqlalchemy import inspect
 from sqlmodel import SQLModel, create_engine
+from .migrations import migrate
+from .partitions import maintain_partitions
 
 
 def create_db_and_tables():
@@ -15,4 +18,9 @@ def create_db_and_tables():
     url = f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
     engine = create_engine(url)
 
+    # create_all only makes the tables that are missing; changes to existing ones are migrations
+    fresh = not inspect(engine).has_table("stocktransactions")
     SQLModel.metadata.create_all(engine)
+    migrate(engine, fresh=fresh)
+    maintain_partitions(engine)
+    return engine
@@ -0,0 +1,173 @@
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+from .models import StockTransactions, WalletTransactions
+from .partitions import partition_start, PARTITION_DAYS
+from datetime import datetime, timedelta, timezone
+
+# held while a migration runs, so two database services starting together don't both apply it
+MIGRATION_LOCK = 4021
+
+
+# The CREATE INDEX for the model's index <name>, so a migration builds exactly what create_all
+# would on a new database
+def index_ddl(model, name: str):
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    return str(
+        CreateIndex(index, if_not_exists=True).compile(dialect=postgresql.dialect())
+    )
+
+
+# Turns <model>'s table into one range partitioned on time_stamp without copying it: the old
+# table is renamed and becomes the partition for everything up to the end of the current
+# partition period, and new partitions follow on from there (see partitions.py).
+def partition_table(connection, model, id_column: str):
+    table = model.__tablename__
+    legacy = f"{table}_legacy"
+
+    connection.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    # a partition can't have a primary key of its own; attaching it builds the table's
+    connection.execute(text(f"ALTER TABLE {legacy} DROP CONSTRAINT {table}_pkey"))
+    # free the names the partitioned table's indexes and id sequence are made with; indexes
+    # the same as the new table's are then taken over by it when the old one is attached
+    indexes = connection.execute(
+        text(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = :table"
+        ),
+        {"table": legacy},
+    ).scalars()
+    for index in list(indexes):
+        connection.execute(
+            text(f"ALTER INDEX {index} RENAME TO {index.replace(table, legacy, 1)}")
+        )
+    connection.execute(
+        text(
+            f"ALTER SEQUENCE {table}_{id_column}_seq "
+            f"RENAME TO {legacy}_{id_column}_seq"
+        )
+    )
+
+    # checkfirst: the enum types it uses are already there
+    model.__table__.create(connection, checkfirst=True)
+    newest = connection.execute(text(f"SELECT max(time_stamp) FROM {legacy}")).scalar()
+    connection.execute(
+        text(
+            f"SELECT setval('{table}_{id_column}_seq', "
+            f"(SELECT coalesce(max({id_column}), 0) + 1 FROM {legacy}), false)"
+        )
+    )
+    end = partition_start(
+        max(newest or datetime.now(timezone.utc), datetime.now(timezone.utc))
+    ) + timedelta(days=PARTITION_DAYS)
+    connection.execute(
+        text(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{end.isoformat()}')"
+        )
+    )
+
+
+def partition_transaction_tables(connection):
+    # a foreign key can't point at a partitioned table by its id alone
+    for table, column in (
+        ("wallettransactions", "stock_tx_id"),
+        ("stocktransactions", "wallet_tx_id"),
+        ("stocktransactions", "parent_stock_tx_id"),
+    ):
+        connection.execute(
+            text(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{column}_fkey")
+        )
+    partition_table(connection, StockTransactions, "stock_tx_id")
+    partition_table(connection, WalletTransactions, "wallet_tx_id")
+
+
+# (version, description, statements). A statement is SQL, or a function run with the
+# connection. Each version is applied once, in order, in its own transaction, and recorded in
+# schema_migrations. A database made by create_all is already at the newest version and is
+# only stamped with them.
+#
+# They are run while the database is quiet: changing a column's type rewrites the table,
+# indexes are built without CONCURRENTLY so they can share the migration's transaction, and
+# attaching the old table as a partition checks every row against its bounds, all of which
+# block writes to the table until they're done.
+MIGRATIONS = [
+    (
+        1,
+        "expires_at on stock transactions",
+        [
+            "ALTER TABLE stocktransactions ADD COLUMN IF NOT EXISTS expires_at bigint",
+        ],
+    ),
+    (
+        2,
+        "time stamps from text to timestamptz",
+        [
+            # written by str(datetime.now()) in containers running on UTC
+            "ALTER TABLE stocktransactions ALTER COLUMN time_stamp TYPE timestamptz "
+            "USING time_stamp::timestamp AT TIME ZONE 'UTC'",
+            "ALTER TABLE wallettransactions ALTER COLUMN time_stamp TYPE timestamptz "
+            "USING time_stamp::timestamp AT TIME ZONE 'UTC'",
+        ],
+    ),
+    (
+        3,
+        "covering (user_id, time_stamp) history indexes and foreign key indexes",
+        [
+            # the history indexes lead with user_id, so these are redundant
+            "DROP INDEX IF EXISTS ix_stocktransactions_user_id",
+            "DROP INDEX IF EXISTS ix_wallettransactions_user_id",
+            index_ddl(StockTransactions, "ix_stocktransactions_user_id_time_stamp"),
+            index_ddl(WalletTransactions, "ix_wallettransactions_user_id_time_stamp"),
+            index_ddl(WalletTransactions, "ix_wallettransactions_stock_tx_id"),
+            index_ddl(StockTransactions, "ix_stocktransactions_parent_stock_tx_id"),
+        ],
+    ),
+    (
+        4,
+        "range partition the transaction tables on time_stamp",
+        [partition_transaction_tables],
+    ),
+]
+
+
+# Applies the migrations <engine>'s database hasn't had yet. <fresh> records them all as
+# applied without running them, for a database create_all has just made.
+def migrate(engine, fresh: bool = False):
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version integer PRIMARY KEY, "
+                "description text NOT NULL, "
+                "applied_at timestamptz NOT NULL DEFAULT now())"
+            )
+        )
+
+    for version, description, statements in MIGRATIONS:
+        with engine.begin() as connection:
+            connection.execute(
+                text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK}
+            )
+            applied = connection.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+                {"version": version},
+            ).first()
+            if applied:
+                continue
+
+            if not fresh:
+                for statement in statements:
+                    if callable(statement):
+                        statement(connection)
+                    else:
+                        connection.execute(text(statement))
+                print(f"applied migration {version}: {description}")
+
+            connection.execute(
+                text(
+                    "INSERT INTO schema_migrations (version, description) "
+                    "VALUES (:version, :description)"
+                ),
+                {"version": version, "description": description},
+            )
@@ -1,7 +1,7 @@
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
-from sqlmodel import SQLModel, Field, BigInteger, Column
+from sqlmodel import SQLModel, Field, BigInteger, Column, DateTime, Index
 
 
 class OrderStatus(str, Enum):
@@ -19,7 +19,13 @@ def generate_user_id():
     return str(uuid.uuid4())
 
 def generate_timestamp():
-    return str(datetime.now())
+    return datetime.now(timezone.utc)
+
+# timestamptz; migrations.py converts the text time stamps of databases made before it.
+# The transaction tables are range partitioned on it (see partitions.py), and Postgres wants
+# the partition key in the primary key, so it's part of theirs.
+def timestamp_column():
+    return Column(DateTime(timezone=True), primary_key=True, nullable=False)
 
 class Users(SQLModel, table=True):
     id: str = Field(default_factory=generate_user_id, primary_key=True)
@@ -35,12 +41,28 @@ class Wallets(SQLModel, table=True):
     balance: int = Field(default=0, sa_column=Column(BigInteger()))
 
 class WalletTransactions(SQLModel, table=True):
-    wallet_tx_id: int = Field(default=None, primary_key=True)
-    stock_tx_id: int = Field(foreign_key="stocktransactions.stock_tx_id")
-    user_id: str = Field(foreign_key="users.id", index=True)
+    # a user's history, oldest first, is read from this index alone (see migrations.py)
+    __table_args__ = (
+        Index(
+            "ix_wallettransactions_user_id_time_stamp",
+            "user_id",
+            "time_stamp",
+            postgresql_include=["wallet_tx_id", "stock_tx_id", "is_debit", "amount"],
+        ),
+        {"postgresql_partition_by": "RANGE (time_stamp)"},
+    )
+
+    wallet_tx_id: int = Field(
+        default=None, primary_key=True, sa_column_kwargs={"autoincrement": True}
+    )
+    # not a foreign key: one can't point at a partitioned table by stock_tx_id alone
+    stock_tx_id: int = Field(index=True)
+    user_id: str = Field(foreign_key="users.id")
     is_debit: bool
     amount: int
-    time_stamp: str = Field(default_factory=generate_timestamp)
+    time_stamp: datetime = Field(
+        default_factory=generate_timestamp, sa_column=timestamp_column()
+    )
 
 
 class Stocks(SQLModel, table=True):
@@ -56,14 +78,99 @@ class StockPortfolios(SQLModel, table=True):
 
 
 class StockTransactions(SQLModel, table=True):
-    stock_tx_id: int = Field(default=None, primary_key=True)
-    wallet_tx_id: int | None = Field(foreign_key="wallettransactions.wallet_tx_id")
+    # a user's history, oldest first, is read from this index alone (see migrations.py)
+    __table_args__ = (
+        Index(
+            "ix_stocktransactions_user_id_time_stamp",
+            "user_id",
+            "time_stamp",
+            postgresql_include=[
+                "stock_tx_id",
+                "wallet_tx_id",
+                "stock_id",
+                "order_status",
+                "is_buy",
+                "order_type",
+                "stock_price",
+                "quantity",
+                "parent_stock_tx_id",
+                "expires_at",
+            ],
+        ),
+        {"postgresql_partition_by": "RANGE (time_stamp)"},
+    )
+
+    stock_tx_id: int = Field(
+        default=None, primary_key=True, sa_column_kwargs={"autoincrement": True}
+    )
+    # these point at other transactions without foreign keys, like WalletTransactions.stock_tx_id
+    wallet_tx_id: int | None = Field(default=None)
     stock_id: int = Field(foreign_key="stocks.stock_id")
     order_status: OrderStatus = Field(default=OrderStatus.IN_PROGRESS)
     is_buy: bool
     order_type: OrderType
     stock_price: int
     quantity: int = Field(sa_column=Column(BigInteger()))
-    parent_stock_tx_id: int | None = Field(foreign_key="stocktransactions.stock_tx_id")
-    time_stamp: str = Field(default_factory=generate_timestamp)
-    user_id: str = Field(foreign_key="users.id", index=True)
+    parent_stock_tx_id: int | None = Field(default=None, index=True)
+    time_stamp: datetime = Field(
+        default_factory=generate_timestamp, sa_column=timestamp_column()
+    )
+    user_id: str = Field(foreign_key="users.id")
+    # seconds since the epoch when a DAY or GTT order stops resting, None for GTC
+    expires_at: int | None = Field(default=None, sa_column=Column(BigInteger()))
+
+
+# A matching engine batch whose book changes are in its partition's journal, written in the
+# batch's own transaction. Restoring the books replays only the journal blocks with a row here,
+# so the changes of a batch that never committed aren't brought back (see persistence.py).
+class JournalCommits(SQLModel, table=True):
+    partition: int = Field(primary_key=True)
+    generation: int = Field(primary_key=True)
+    batch: int = Field(primary_key=True)
+
+
+# The id of every settlement leg settled, written in the transaction that settles it, so a leg
+# its queue delivers again is skipped rather than settled twice (see settleLegs). Rows older
+# than SETTLED_LEG_RETENTION_DAYS are pruned by the database service.
+class SettledLegs(SQLModel, table=True):
+    leg_id: str = Field(primary_key=True)
+    settled_at: datetime = Field(
+        sa_column=Column(
+            DateTime(timezone=True),
+            default=generate_timestamp,
+            nullable=False,
+            index=True,
+        )
+    )
+
+
+# A settlement leg the settlement workers couldn't settle, even on its own, set aside here in
+# the transaction that settled the rest of its batch so its message can be acked without losing
+# it. <leg> is the leg as queued (SettlementLeg JSON); once the cause is fixed it can be put back
+# on <queue>.
+class FailedSettlements(SQLModel, table=True):
+    leg_id: str = Field(primary_key=True)
+    queue: str
+    leg: str
+    error: str
+    failed_at: datetime = Field(
+        sa_column=Column(
+            DateTime(timezone=True), default=generate_timestamp, nullable=False
+        )
+    )
+
+
+# Settlement messages of matching engine batches, written in the batch's own transaction so a
+# committed batch's legs survive the engine stopping before they're published. <body> is the
+# Settlements JSON for <queue>. A settlement worker deletes a row in the transaction that
+# settles its legs, so the rows are the fills not settled yet, which a rebuild of the books
+# counts (see getRestingOrders). The engine publishes what its partition left behind when it
+# starts (see queueSettlements).
+class SettlementOutbox(SQLModel, table=True):
+    id: int = Field(
+        default=None,
+        sa_column=Column(BigInteger(), primary_key=True, autoincrement=True),
+    )
+    partition: int = Field(index=True)
+    queue: str
+    body: str
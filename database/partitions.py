@@ -0,0 +1,163 @@
+import os
+import dotenv
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+
+dotenv.load_dotenv(override=True)
+
+# The transaction tables are range partitioned on time_stamp, PARTITION_DAYS to a partition.
+# maintain_partitions keeps PARTITIONS_AHEAD partitions made past the current one, and takes
+# the ones that ended more than RETENTION_DAYS ago out of the tables (0 keeps them all):
+# ARCHIVE=schema moves them into the ARCHIVE_SCHEMA schema as plain tables, ARCHIVE=drop drops
+# them.
+PARTITION_DAYS = int(os.getenv("TRANSACTION_PARTITION_DAYS") or 7)
+PARTITIONS_AHEAD = int(os.getenv("TRANSACTION_PARTITIONS_AHEAD") or 4)
+RETENTION_DAYS = int(os.getenv("TRANSACTION_RETENTION_DAYS") or 0)
+ARCHIVE = os.getenv("TRANSACTION_ARCHIVE") or "schema"
+ARCHIVE_SCHEMA = "transactions_archive"
+
+PARTITIONED_TABLES = ("stocktransactions", "wallettransactions")
+
+# partitions start on a Monday at midnight UTC, counting from this one
+ANCHOR = datetime(2000, 1, 3, tzinfo=timezone.utc)
+
+
+# Start of the partition holding <at>
+def partition_start(at: datetime):
+    width = timedelta(days=PARTITION_DAYS)
+    return ANCHOR + (at - ANCHOR) // width * width
+
+
+def partition_name(table: str, start: datetime):
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def default_partition(table: str):
+    return f"{table}_default"
+
+
+# (name, lower, upper) of every range partition of <table>, lower None from MINVALUE; the
+# default partition isn't included
+def partition_bounds(connection, table: str):
+    rows = connection.execute(
+        text(
+            "SELECT c.relname, "
+            "substring(pg_get_expr(c.relpartbound, c.oid) FROM $$FROM \\('(.*)'\\) TO$$)"
+            "::timestamptz, "
+            "substring(pg_get_expr(c.relpartbound, c.oid) FROM $$TO \\('(.*)'\\)$$)"
+            "::timestamptz "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table) "
+            "AND pg_get_expr(c.relpartbound, c.oid) <> 'DEFAULT' "
+            "ORDER BY 3"
+        ),
+        {"table": table},
+    )
+    return rows.all()
+
+
+# Makes the partitions of <table> from the one holding <since> (now by default) to
+# PARTITIONS_AHEAD past the current one, skipping any range a partition already covers, and
+# the default partition that catches rows outside them all.
+#
+# A new partition is made as a plain table and attached, after moving across any rows the
+# default partition took for its range, so falling behind only costs that move.
+def ensure_partitions(connection, table: str, since: datetime = None):
+    now = datetime.now(timezone.utc)
+    connection.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {default_partition(table)} "
+            f"PARTITION OF {table} DEFAULT"
+        )
+    )
+
+    existing = partition_bounds(connection, table)
+    width = timedelta(days=PARTITION_DAYS)
+    start = partition_start(since or now)
+    last = partition_start(now) + PARTITIONS_AHEAD * width
+    made = []
+
+    while start <= last:
+        end = start + width
+        covered = any(
+            (lower is None or lower < end) and start < upper
+            for _, lower, upper in existing
+        )
+        if not covered:
+            name = partition_name(table, start)
+            bounds = {"start": start, "end": end}
+            connection.execute(
+                text(
+                    f"CREATE TABLE {name} "
+                    f"(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                )
+            )
+            connection.execute(
+                text(
+                    f"WITH moved AS (DELETE FROM {default_partition(table)} "
+                    f"WHERE time_stamp >= :start AND time_stamp < :end RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved"
+                ),
+                bounds,
+            )
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )
+            )
+            made.append(name)
+        start = end
+    return made
+
+
+# Detaches the partitions of <table> that ended more than RETENTION_DAYS ago and archives or
+# drops them per ARCHIVE, oldest first. A stock transaction partition still holding an open
+# order is kept, and so is every one after it: the engine reloads open orders from the table
+# when it restarts, along with their fills, which are in the same or later partitions.
+def archive_partitions(connection, table: str):
+    if not RETENTION_DAYS:
+        return []
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
+    archived = []
+    for name, _, upper in partition_bounds(connection, table):
+        if upper > cutoff:
+            break
+
+        if table == "stocktransactions":
+            open_order = connection.execute(
+                text(
+                    f"SELECT 1 FROM {name} "
+                    "WHERE order_status IN ('IN_PROGRESS', 'PARTIALLY_COMPLETE') LIMIT 1"
+                )
+            ).first()
+            if open_order:
+                print(
+                    f"keeping {name} and later partitions: it still holds open orders",
+                    flush=True,
+                )
+                break
+
+        connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        if ARCHIVE == "drop":
+            connection.execute(text(f"DROP TABLE {name}"))
+        else:
+            connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+            connection.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+        archived.append(name)
+    return archived
+
+
+# Makes and archives partitions for both tables, each table in its own transaction
+def maintain_partitions(engine):
+    for table in PARTITIONED_TABLES:
+        with engine.begin() as connection:
+            made = ensure_partitions(connection, table)
+            archived = archive_partitions(connection, table)
+        if made or archived:
+            print(
+                f"{table}: made {', '.join(made) or 'no'} partitions, "
+                f"archived {', '.join(archived) or 'none'}",
+                flush=True,
+            )
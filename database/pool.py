@@ -0,0 +1,204 @@
+import asyncio
+import os
+import time
+import uuid
+import dotenv
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+
+dotenv.load_dotenv(override=True)
+
+# How a service gets its connections, per deployment:
+#   queue - DB_POOL_SIZE connections kept open in the process (and up to DB_POOL_MAX_OVERFLOW
+#           more while it's busy), so a session doesn't pay for a connect and login, and the
+#           statements a connection has prepared stay prepared for the next session
+#   null  - a new connection for every session, leaving the pooling to pgbouncer
+DB_POOL = os.getenv("DB_POOL") or "queue"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE") or 10)
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW") or 10)
+# seconds to wait for a connection when they're all in use before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT") or 30)
+# connections older than this many seconds are replaced when next checked out
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE") or 1800)
+# prepared statements kept per connection, 0 to prepare every statement each time
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE") or 256)
+
+# pgbouncer by default; point these at the database itself to skip it
+DB_HOST = os.getenv("DB_HOST") or "pgbouncer"
+DB_PORT = int(os.getenv("DB_PORT") or 6432)
+
+
+def database_url():
+    username = os.getenv("USERNAME")
+    password = os.getenv("PASSWORD")
+    db_name = os.getenv("DB_NAME")
+    return f"postgresql+asyncpg://{username}:{password}@{DB_HOST}:{DB_PORT}/{db_name}"
+
+
+# asyncpg names its prepared statements __asyncpg_stmt_<n>__, counting from 1 on every
+# connection, so behind pgbouncer in transaction mode two clients can prepare different
+# statements under the same name on one server connection. Names that are unique across
+# processes can't collide; pgbouncer (max_prepared_statements in pgbouncer.ini) then prepares
+# them on whichever server connection runs the transaction.
+def unique_statement_name():
+    return f"__asyncpg_{uuid.uuid4().hex}__"
+
+
+class PoolStats:
+    """Counters for one service's connections, kept by the pool and its events."""
+
+    def __init__(self, service: str, size: int):
+        self.service = service
+        self.size = size
+        self.opened = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.invalidated = 0
+        # time spent waiting for a connection (opening it, for a new one), and the longest
+        # wait since the last report
+        self.wait_seconds = 0.0
+        self.worst_wait = 0.0
+
+    def waited(self, seconds: float):
+        self.checkouts += 1
+        self.wait_seconds += seconds
+        self.worst_wait = max(self.worst_wait, seconds)
+
+
+class TimedPool:
+    """Times every connection checkout into the pool's PoolStats."""
+
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.stats is not None:
+                self.stats.waited(time.perf_counter() - start)
+
+    # the pool is replaced by a copy of itself when the engine is disposed
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class TimedQueuePool(TimedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+class TimedNullPool(TimedPool, NullPool):
+    pass
+
+
+# service name -> (engine, PoolStats)
+pools = {}
+
+
+# The engine for <service>, made the first time it's asked for with the DB_* settings above
+def engine_for(service: str):
+    if service in pools:
+        return pools[service][0]
+
+    connect_args = {
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "prepared_statement_name_func": unique_statement_name,
+    }
+    if DB_POOL == "null":
+        engine = create_async_engine(
+            database_url(),
+            echo=False,
+            poolclass=TimedNullPool,
+            connect_args=connect_args,
+        )
+        stats = PoolStats(service, 0)
+    elif DB_POOL == "queue":
+        engine = create_async_engine(
+            database_url(),
+            echo=False,
+            poolclass=TimedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            connect_args=connect_args,
+        )
+        stats = PoolStats(service, DB_POOL_SIZE)
+    else:
+        raise ValueError(f"DB_POOL must be queue or null, not {DB_POOL}")
+
+    engine.pool.stats = stats
+    watch_pool(engine, stats)
+    pools[service] = (engine, stats)
+    return engine
+
+
+def watch_pool(engine, stats: PoolStats):
+    @event.listens_for(engine.sync_engine, "connect")
+    def opened(dbapi_connection, record):
+        stats.opened += 1
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def checked_out(dbapi_connection, record, proxy):
+        stats.checked_out += 1
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def checked_in(dbapi_connection, record):
+        stats.checked_out -= 1
+
+    @event.listens_for(engine.sync_engine, "invalidate")
+    def invalidated(dbapi_connection, record, exception):
+        stats.invalidated += 1
+
+
+def session_maker_for(service: str):
+    return async_sessionmaker(
+        bind=engine_for(service), class_=AsyncSession, expire_on_commit=False
+    )
+
+
+# Every pool's counters in the Prometheus text format, labelled by service
+def render_pool_metrics():
+    metrics = (
+        ("db_pool_size", "gauge", "Connections the pool keeps open", "size"),
+        ("db_pool_checked_out", "gauge", "Connections in use", "checked_out"),
+        ("db_pool_connections_opened_total", "counter", "New connections", "opened"),
+        ("db_pool_checkouts_total", "counter", "Connection checkouts", "checkouts"),
+        (
+            "db_pool_checkout_wait_seconds_total",
+            "counter",
+            "Time spent waiting for a connection",
+            "wait_seconds",
+        ),
+        (
+            "db_pool_invalidations_total",
+            "counter",
+            "Connections thrown away after an error",
+            "invalidated",
+        ),
+    )
+    lines = []
+    for name, kind, help, field in metrics:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for _, stats in pools.values():
+            lines.append(f'{name}{{service="{stats.service}"}} {getattr(stats, field)}')
+    return "\n".join(lines) + "\n"
+
+
+# Prints every pool's counters every <interval> seconds, for services without a metrics port
+async def report_pools(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for _, stats in pools.values():
+            print(
+                f"{stats.service} db pool: {stats.checked_out} in use, "
+                f"{stats.opened} opened, {stats.checkouts} checkouts, "
+                f"worst wait {stats.worst_wait * 1000:.1f}ms, "
+                f"{stats.invalidated} invalidated",
+                flush=True,
+            )
+            stats.worst_wait = 0.0
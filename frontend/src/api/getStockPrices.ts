@@ -9,6 +9,7 @@ export interface Stock {
   stock_id: number;
   stock_name: string;
   current_price: number;
+  quantity_available: number;
 }
 
 async function getStockPrices(): Promise<Stock[]> {
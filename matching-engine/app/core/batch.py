@@ -0,0 +1,89 @@
+import time
+from datetime import datetime
+from schemas.marketdata import Trade
+from schemas.settlement import SettlementLeg
+
+
+class Batch:
+    """The orders taken off the queue together, and the database session they share.
+
+    Handlers write through ``session`` without committing, and register how to undo each
+    book change they make once its database work has gone through. If the batch's commit
+    fails, ``rollback`` undoes all of them, newest first, so the books match the database again.
+
+    ``trades`` collects the trades the batch makes, to be published once it has committed,
+    ``settlements`` the legs to queue for the settlement workers once it has, and ``orders`` the
+    (stock_id, OrderRecord) pairs to add to the order history.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.undo = []
+        self.trades = []
+        self.settlements = []
+        self.orders = []
+        self.started = time.time()
+
+    def onRollback(self, action, *args):
+        self.undo.append((action, args))
+
+    def onTrade(self, stock_id: int, price: int, quantity: int):
+        self.trades.append(
+            Trade(
+                stock_id=stock_id,
+                price=price,
+                quantity=quantity,
+                timestamp=str(datetime.now()),
+            )
+        )
+
+    # Queues the settlement of <quantity> of <order> filled at <price>. <order> is a resting
+    # order whose amount_sold already includes the fill.
+    def onFill(self, order, quantity: int, price: int):
+        self.settlements.append(
+            SettlementLeg(
+                user_id=order.user_id,
+                stock_id=order.stock_id,
+                stock_tx_id=order.stock_tx_id,
+                is_buy=order.is_buy,
+                order_type=order.order_type,
+                quantity=quantity,
+                price=price,
+                amount=price * quantity,
+                limit_price=order.price if order.is_buy else None,
+                completes=order.amount_sold == order.quantity,
+                matched_at=self.started,
+            )
+        )
+
+    # Queues the settlement of the buyer's side of a market buy
+    def onMarketBuy(self, buyOrder, cost: int):
+        self.settlements.append(
+            SettlementLeg(
+                user_id=buyOrder.user_id,
+                stock_id=buyOrder.stock_id,
+                is_buy=True,
+                order_type=buyOrder.order_type,
+                quantity=buyOrder.quantity,
+                price=cost // buyOrder.quantity,
+                amount=cost,
+                matched_at=self.started,
+            )
+        )
+
+    def onOrder(self, stock_id: int, record):
+        self.orders.append((stock_id, record))
+
+    def mark(self):
+        return len(self.undo), len(self.trades), len(self.settlements), len(self.orders)
+
+    # Undoes the book changes and drops the trades, settlements and order records made after
+    # <mark>, newest first
+    def rollback(self, mark=(0, 0, 0, 0)):
+        undoMark, tradeMark, settlementMark, orderMark = mark
+        while len(self.undo) > undoMark:
+            action, args = self.undo.pop()
+            action(*args)
+        del self.trades[tradeMark:]
+        del self.settlements[settlementMark:]
+        del self.orders[orderMark:]
@@ -1,276 +1,696 @@
-from typing import List
-
-from sqlalchemy import except_
 from schemas import SuccessResponse, RabbitError
 from schemas.RedisClient import RedisClient, CacheName
-from schemas.engine import StockOrder, SellOrder, BuyOrder, StockPrice, CancelOrder
-from datetime import datetime
+from schemas.engine import (
+    StockOrder,
+    BuyOrder,
+    CancelOrder,
+    DepthRequest,
+    DepthLevel,
+    MAX_DEPTH_LEVELS,
+    StockDepth,
+    RecentOrdersRequest,
+    RecentOrder,
+    MemoryReport,
+    CandlesRequest,
+    Candle,
+)
+from schemas.marketdata import MarketData
+from schemas.partitioning import (
+    engine_partition,
+    engine_partitions,
+    partition_for,
+    settlement_workers,
+    settlement_queue_for,
+)
+from datetime import datetime, timezone, timedelta
 from collections import defaultdict, deque
-from heapq import heapify, heappop, heappush
 from .engineDbConnect import *
 from .db_methods import *
-import copy
-
-sellTrees = defaultdict(list)
-buyQueues = defaultdict(deque)
+from .orderbook import OrderBook, RestingOrder
+from .batch import Batch
+from .prices import BookChanges, PriceBoard, DepthBoard
+from .ledger import RiskLedger
+from .tape import TradeTape
+from .timewheel import TimingWheel
+from .history import OrderHistory, OrderRecord, recordOf, marketBuyRecord
+from .memory import (
+    containerLimit,
+    containerUsage,
+    processRss,
+    booksBytes,
+    historyBytes,
+    ledgerBytes,
+)
+from .persistence import Journal, loadBooks, writeSnapshot, forkSnapshot
+import asyncio
+import os
+import sys
+from itertools import count
+from time import perf_counter, time as wallClock
+
+# this engine only holds the books for stocks where stock_id % partitions == partition
+partitions = engine_partitions()
+partition = engine_partition()
+
+# Fills are settled in the database by the settlement workers (see settlement.py). Each
+# account's legs always go to the same worker's queue, so they settle in the order they matched.
+SETTLEMENT_WORKERS = settlement_workers()
+
+ENGINE_DATA_DIR = os.getenv("ENGINE_DATA_DIR") or "engine-data"
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL") or 60)
+# How often memory is checked, and the share of the container's limit that raises an alert
+MEMORY_CHECK_INTERVAL = float(os.getenv("MEMORY_CHECK_INTERVAL") or 30)
+MEMORY_ALERT_RATIO = float(os.getenv("MEMORY_ALERT_RATIO") or 0.8)
+# When DAY orders expire, as HH:MM in UTC
+MARKET_CLOSE = os.getenv("MARKET_CLOSE") or "21:00"
+journal = Journal(ENGINE_DATA_DIR, partition, fsync=os.getenv("JOURNAL_FSYNC") == "1")
+
+# stock_tx_id -> resting order, shared by every book on both sides
+orderIndex = {}
+sellTrees = defaultdict(lambda: OrderBook(orderIndex, journal, listener=bookChanges))
+buyTrees = defaultdict(
+    lambda: OrderBook(orderIndex, journal, is_buy=True, listener=bookChanges)
+)
+books = (sellTrees, buyTrees)
+# what GET_PRICES and GET_DEPTH read, updated as batches commit (see BookChanges)
+priceBoard = PriceBoard(sellTrees, getStockNames)
+depthBoard = DepthBoard(buyTrees, sellTrees)
+bookChanges = BookChanges(priceBoard, depthBoard)
+
+# cash and shares available to new orders, checked before the database is (see RiskLedger)
+ledger = RiskLedger(getWalletBalance, getHolding)
+
+# the last orders placed or cancelled on each stock (see OrderHistory)
+history = OrderHistory()
+
+# executed trades and their candles
+tape = TradeTape()
+
+# time priority of resting orders
+sequence = count()
+
+# resting DAY and GTT orders by the second they expire, and those that have, per stock, waiting
+# for their stock's actor to cancel them
+wheel = TimingWheel(int(wallClock()))
+pendingExpiry = defaultdict(deque)
+
+# trades committed since the market data was last published
+committedTrades = []
+
+# (outbox id, queue, legs) of the settlement messages committed but not yet handed to the
+# settlement queues
+committedSettlements = []
+
+# A snapshot is only taken while no batch is running, so it never holds a batch's changes
+# before that batch's journal block is known to count. batchesIdle is set while none is
+# running, and batchesMayStart cleared while a snapshot waits for that.
+batchesRunning = 0
+batchesIdle = asyncio.Event()
+batchesIdle.set()
+batchesMayStart = asyncio.Event()
+batchesMayStart.set()
 
 cache = RedisClient()
 
 
-async def receiveOrder(order: StockOrder, sending_user_id: str):
+def ownsStock(stock_id: int):
+    return partition_for(stock_id, partitions) == partition
+
+
+# Restores the books for the stocks this partition owns from the last snapshot and journal,
+# replaying only the journal blocks of batches that committed. If there is no snapshot for the
+# current partition layout they are rebuilt from the orders still open in the database
+# instead, which is also how books move to a new owner when the partition count changes.
+async def restoreBooks():
+    global sequence
+
+    start = perf_counter()
+    committed = await getJournalCommits(partition)
+    # the boards are only updated once the books are loaded, not for every order
+    with bookChanges.batch() as restored:
+        snapshotGeneration = loadBooks(
+            books, orderIndex, journal, partitions, committed
+        )
+        journal.open()
+        if snapshotGeneration is None:
+            await restoreBooksFromDb()
+    bookChanges.commit(restored)
+
+    if snapshotGeneration is None:
+        writeSnapshot(books, ENGINE_DATA_DIR, partition, partitions, journal.generation)
+        snapshotGeneration = journal.generation
+        # whatever blocks were recorded belong to journals this snapshot replaces
+        await pruneJournalCommits(partition)
+        source = "database"
+    else:
+        source = "snapshot"
+
+    journal.prune(snapshotGeneration)
+    await pruneJournalCommits(partition, snapshotGeneration)
+    sequence = count(max((order.seq for order in orderIndex.values()), default=-1) + 1)
+    for order in orderIndex.values():
+        if order.expires_at is not None:
+            wheel.schedule(order.expires_at, order)
+
+    ledger.hydrate(*await getLedgerBalances(partition, partitions))
+    print(
+        f"partition {partition}/{partitions}: restored {len(orderIndex)} resting orders "
+        f"from {source} and {len(ledger.cash)} wallets, {len(ledger.shares)} holdings "
+        f"in {perf_counter() - start:.2f}s"
+    )
+
+
+async def restoreBooksFromDb():
+    for stockTx, amountSold in await getRestingOrders(partition, partitions):
+        books[stockTx.is_buy][stockTx.stock_id].add(
+            RestingOrder(
+                stock_tx_id=stockTx.stock_tx_id,
+                user_id=sys.intern(stockTx.user_id),
+                stock_id=stockTx.stock_id,
+                price=stockTx.stock_price,
+                quantity=stockTx.quantity,
+                amount_sold=amountSold,
+                seq=next(sequence),
+                order_type=stockTx.order_type.value,
+                is_buy=stockTx.is_buy,
+                expires_at=stockTx.expires_at,
+            )
+        )
+
+
+# Snapshots the books every SNAPSHOT_INTERVAL seconds. New batches are held back until the ones
+# running have finished and the child is forked; the child writes the snapshot and once it has
+# succeeded the journals it covers are deleted.
+async def snapshotBooks():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+        batchesMayStart.clear()
+        try:
+            await batchesIdle.wait()
+            pid, generation = forkSnapshot(books, journal, partitions)
+        finally:
+            batchesMayStart.set()
+
+        while True:
+            await asyncio.sleep(0.1)
+            donePid, status = os.waitpid(pid, os.WNOHANG)
+            if donePid:
+                break
+
+        if os.waitstatus_to_exitcode(status) == 0:
+            journal.prune(generation)
+            await pruneJournalCommits(partition, generation)
+        else:
+            print(f"snapshot of partition {partition} failed, keeping journals")
+
+
+# Runs <jobs> in arrival order inside one database transaction. A job is a coroutine function
+# that takes the Batch and returns the reply for its message. <accounts> are the accounts the
+# jobs will write to (see accountOf); they are locked in a fixed order before any job runs, so
+# batches for different stocks can't deadlock on them (see lockAccounts).
+#
+# Each job gets its own savepoint, so one that fails is rolled back on its own (along with any
+# book changes it registered) and the rest of the batch carries on. If the commit fails, every
+# book change the batch made is undone and every job that had succeeded is failed.
+#
+# The batch's book changes are written to the journal as one block just before the commit, and
+# the commit records the block (see Journal.commit), so the journal always has the changes of a
+# committed batch and a restore skips those of one that didn't commit. Its settlement legs are
+# written to the outbox in the same transaction, for queueSettlements to publish. The price
+# and depth boards only take the batch's book changes once it has committed.
+#
+# Outputs:
+#           - list of (status, response), one per job, in the same order
+async def processBatch(jobs, accounts=()):
+    global batchesRunning
+
+    await batchesMayStart.wait()
+    batchesRunning += 1
+    batchesIdle.clear()
+    try:
+        with journal.batch() as journalRecords, bookChanges.batch() as bookMoves:
+            return await runBatch(jobs, accounts, journalRecords, bookMoves)
+    finally:
+        batchesRunning -= 1
+        if not batchesRunning:
+            batchesIdle.set()
+
+
+async def runBatch(jobs, accounts, journalRecords, bookMoves):
+    results = []
+
+    async with async_session_maker() as session:
+        batch = Batch(session)
+
+        try:
+            await lockAccounts(
+                session,
+                {account for account in accounts if isinstance(account, str)},
+                {account for account in accounts if isinstance(account, tuple)},
+            )
+        except Exception as e:
+            print(f"locking the accounts of a batch of {len(jobs)} failed: {e}")
+            return [("ERROR", errorResponse(e))] * len(jobs)
+
+        for job in jobs:
+            mark = batch.mark()
+            try:
+                async with session.begin_nested():
+                    response = await job(batch)
+                results.append(("SUCCESS", response))
+            except Exception as e:
+                batch.rollback(mark)
+                results.append(("ERROR", errorResponse(e)))
+
+        try:
+            if batch.trades:
+                await setCurrentPrices(
+                    session, {trade.stock_id: trade.price for trade in batch.trades}
+                )
+            outbox = await writeSettlementOutbox(
+                session, partition, settlementsByQueue(batch.settlements)
+            )
+            block = journal.commit(journalRecords)
+            if block is not None:
+                await recordJournalCommit(session, partition, *block)
+            await session.commit()
+            bookChanges.commit(bookMoves)
+            committedTrades.extend(batch.trades)
+            committedSettlements.extend(outbox)
+            for stock_id, record in batch.orders:
+                history.record(stock_id, record)
+            committedAt = wallClock()
+            for trade in batch.trades:
+                tape.record(trade.stock_id, trade.price, trade.quantity, committedAt)
+        except Exception as e:
+            print(f"batch of {len(jobs)} failed to commit: {e}")
+            batch.rollback()
+            results = [
+                result if result[0] == "ERROR" else ("ERROR", errorResponse(e))
+                for result in results
+            ]
+
+    return results
+
+
+# Everything that changed since the last call, to publish on the market data exchange:
+# the stocks whose best ask or volume moved and the trades that were committed
+def takeMarketData():
+    marketData = MarketData(prices=priceBoard.changes(), trades=committedTrades[:])
+    committedTrades.clear()
+    return marketData
+
+
+# The settlement messages, (outbox id, queue, legs), of everything committed since the last
+# call, to queue for the workers
+def takeSettlements():
+    settlements = committedSettlements[:]
+    committedSettlements.clear()
+    return settlements
+
+
+# Takes up the settlement messages a previous run of this partition left in the outbox, to be
+# queued again before anything new. Some may still be on their queues; the workers skip the
+# legs of whichever copy comes second (see claimLegs).
+async def restoreSettlements():
+    committedSettlements[:0] = await getSettlementOutbox(partition)
+
+
+# queue -> the legs in <legs> for it, in order
+def settlementsByQueue(legs):
+    byQueue = defaultdict(list)
+    for leg in legs:
+        byQueue[settlement_queue_for(leg.user_id, SETTLEMENT_WORKERS)].append(leg)
+    return byQueue
+
+
+def errorResponse(error: Exception):
+    if isinstance(error, ValueError) and len(error.args) == 2:
+        return RabbitError(status_code=error.args[0], detail=error.args[1])
+    return RabbitError(status_code=500, detail="Internal Server Error")
+
+
+# When an order placed now with <order>'s time in force stops resting, as seconds since the
+# epoch, or None if it rests until it is filled or cancelled
+def expiryOf(order: StockOrder):
+    if order.time_in_force == "GTC" or (order.is_buy and order.order_type == "MARKET"):
+        return None
+
+    now = datetime.now(timezone.utc)
+    if order.time_in_force == "DAY":
+        hour, minute = map(int, MARKET_CLOSE.split(":"))
+        close = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if close <= now:
+            close += timedelta(days=1)
+        return int(close.timestamp())
+
+    if order.expires_at is None:
+        raise ValueError(400, "GTT orders need an expires_at")
+    expiresAt = order.expires_at
+    if expiresAt.tzinfo is None:
+        expiresAt = expiresAt.replace(tzinfo=timezone.utc)
+    if expiresAt <= now:
+        raise ValueError(400, "expires_at must be in the future")
+    return int(expiresAt.timestamp())
+
+
+async def receiveOrder(order: StockOrder, sending_user_id: str, batch: Batch):
     time = str(datetime.now())
 
-    if order.is_buy:
+    if not ownsStock(order.stock_id):
+        raise ValueError(409, "stock is handled by another matching engine partition")
+
+    if order.order_type == "LIMIT" or not order.is_buy:
+        if order.price is None or order.price <= 0:
+            raise ValueError(400, "limit and sell orders need a price greater than 0")
+
+    expiresAt = expiryOf(order)
+
+    if order.is_buy and order.order_type == "LIMIT":
+        await processLimitBuyOrder(
+            batch,
+            RestingOrder(
+                stock_tx_id=None,
+                user_id=sys.intern(sending_user_id),
+                stock_id=order.stock_id,
+                price=order.price,
+                quantity=order.quantity,
+                amount_sold=0,
+                seq=next(sequence),
+                order_type="LIMIT",
+                is_buy=True,
+                expires_at=expiresAt,
+            ),
+        )
+        return SuccessResponse()
+
+    elif order.is_buy:
+        # turn away market buys the book can't fill before doing any work for them
+        book = sellTrees.get(order.stock_id)
+        if book is None:
+            raise ValueError(400, "not enough sell volume to fill buy order")
+        book.check(sending_user_id, order.quantity)
+
         await processBuyOrder(
+            batch,
             BuyOrder(
                 user_id=sending_user_id,
                 stock_id=order.stock_id,
                 quantity=order.quantity,
                 timestamp=time,
                 order_type=order.order_type,
-                price=0,
-            )
+            ),
         )
         return SuccessResponse()
 
     else:
         await processSellOrder(
-            SellOrder(
-                user_id=sending_user_id,
+            batch,
+            RestingOrder(
+                stock_tx_id=None,
+                user_id=sys.intern(sending_user_id),
                 stock_id=order.stock_id,
-                quantity=order.quantity,
                 price=order.price,
-                timestamp=time,
-                order_type=order.order_type,
-                is_child=False,
+                quantity=order.quantity,
                 amount_sold=0,
+                seq=next(sequence),
+                order_type=sys.intern(order.order_type),
+                expires_at=expiresAt,
             ),
         )
         return SuccessResponse()
 
 
-async def getStockPriceEngine():
-    global sellTrees
+# The account an order takes from or gives back to: the user's wallet (their user_id) for a
+# buy, their holding of the stock ((user_id, stock_id)) for a sell
+def accountOf(user_id: str, stock_id: int, is_buy: bool):
+    return user_id if is_buy else (user_id, stock_id)
 
-    cache_hit = cache.get(CacheName.STOCKS)
-    data = []
-
-    if cache_hit:
-        for stock_id, stock_name in cache_hit.items():
-            # Need to cast id to int because it's stored as a string
-            id = int(stock_id)
-            if sellTrees[id]:
-                data.append(
-                    StockPrice(
-                        stock_id=id,
-                        stock_name=stock_name,
-                        current_price=sellTrees[id][0].price,
-                    )
-                )
-    else:
-        print("CACHE MISS in get stock price")
-        stockList = await getStockData()
-        for stock in stockList:
-            id = stock.stock_id
-            if sellTrees[id]:
-                data.append(
-                    StockPrice(
-                        stock_id=id,
-                        stock_name=stock.stock_name,
-                        current_price=sellTrees[id][0].price,
-                    )
+
+# The accounts cancelling a resting order gives back to, none if the engine doesn't hold it
+def accountsOfOrder(stock_tx_id):
+    order = orderIndex.get(stock_tx_id)
+    if order is None:
+        return []
+    return [accountOf(order.user_id, order.stock_id, order.is_buy)]
+
+
+# The stock of a resting order, or None if the engine doesn't hold it
+def stockForOrder(stock_tx_id):
+    order = orderIndex.get(stock_tx_id)
+    return None if order is None else order.stock_id
+
+
+# Up to <limit> of the user's latest orders on a stock, newest first, from the order history
+async def getRecentOrdersEngine(request: RecentOrdersRequest, user_id: str):
+    if not ownsStock(request.stock_id):
+        raise ValueError(409, "stock is handled by another matching engine partition")
+
+    if request.limit <= 0:
+        raise ValueError(400, "limit must be greater than 0")
+
+    return SuccessResponse(
+        data=[
+            RecentOrder(
+                stock_tx_id=record.stock_tx_id,
+                is_buy=record.is_buy,
+                order_type=record.order_type,
+                price=record.price,
+                quantity=record.quantity,
+                filled=record.filled,
+                status=record.status,
+                timestamp=str(datetime.fromtimestamp(record.timestamp)),
+            )
+            for record in history.recent(request.stock_id, user_id, request.limit)
+        ]
+    )
+
+
+# The newest candles of a stock, oldest first, from the trade tape
+async def getCandlesEngine(request: CandlesRequest):
+    if not ownsStock(request.stock_id):
+        raise ValueError(409, "stock is handled by another matching engine partition")
+
+    if request.limit <= 0:
+        raise ValueError(400, "limit must be greater than 0")
+
+    return SuccessResponse(
+        data=[
+            Candle(
+                start=start, open=open, high=high, low=low, close=close, volume=volume
+            )
+            for start, open, high, low, close, volume in tape.candles(
+                request.stock_id, request.interval, request.limit
+            )
+        ]
+    )
+
+
+def memoryReport():
+    sample = RestingOrder(
+        stock_tx_id=0,
+        user_id="",
+        stock_id=0,
+        price=0,
+        quantity=0,
+        amount_sold=0,
+        seq=0,
+        order_type="LIMIT",
+    )
+    record = OrderRecord(0.0, 0, "", False, "LIMIT", 0, 0, 0, "")
+    return MemoryReport(
+        partition=partition,
+        resting_orders=len(orderIndex),
+        books_bytes=booksBytes(books, sys.getsizeof(sample)),
+        index_bytes=sys.getsizeof(orderIndex),
+        history_orders=len(history),
+        history_bytes=historyBytes(history, sys.getsizeof(record)),
+        ledger_bytes=ledgerBytes(ledger),
+        tape_bytes=tape.nbytes(),
+        process_rss_bytes=processRss(),
+        container_usage_bytes=containerUsage(),
+        container_limit_bytes=containerLimit(),
+    )
+
+
+# A list like every broadcast reply, so the broker can merge the partitions' reports
+async def getMemoryEngine():
+    return SuccessResponse(data=[memoryReport()])
+
+
+# Logs the memory report every MEMORY_CHECK_INTERVAL seconds, and an alert once the container
+# has used MEMORY_ALERT_RATIO of its limit. The alert is repeated only after usage has dropped
+# back below it.
+async def watchMemory():
+    alerting = False
+    while True:
+        await asyncio.sleep(MEMORY_CHECK_INTERVAL)
+
+        report = memoryReport()
+        used = report.container_usage_bytes or report.process_rss_bytes
+        limit = report.container_limit_bytes
+        print(f"memory: {report.model_dump_json()}")
+
+        if limit and used >= MEMORY_ALERT_RATIO * limit:
+            if not alerting:
+                print(
+                    f"ALERT partition {partition}: using {used / 2**20:.0f} MiB of its "
+                    f"{limit / 2**20:.0f} MiB memory limit"
                 )
-    return SuccessResponse(data=data)
+            alerting = True
+        else:
+            alerting = False
+
 
+# The GET_PRICES reply, already serialized (see PriceBoard)
+async def getStockPriceEngine():
+    return await priceBoard.reply()
 
-async def processSellOrder(sellOrder: SellOrder):
+
+# The best <levels> price levels on each side of a stock's book, with their quantity and
+# number of orders, as of the last batch of the stock that committed (see DepthBoard)
+async def getDepthEngine(request: DepthRequest):
+    if not ownsStock(request.stock_id):
+        raise ValueError(409, "stock is handled by another matching engine partition")
+
+    if request.levels <= 0:
+        raise ValueError(400, "levels must be greater than 0")
+
+    if request.levels > MAX_DEPTH_LEVELS:
+        raise ValueError(400, f"levels must be at most {MAX_DEPTH_LEVELS}")
+
+    bids, asks = (
+        [
+            DepthLevel(price=price, quantity=quantity, orders=orders)
+            for price, quantity, orders in levels
+        ]
+        for levels in depthBoard.depth(request.stock_id, request.levels)
+    )
+    return SuccessResponse(
+        data=StockDepth(stock_id=request.stock_id, bids=bids, asks=asks).model_dump()
+    )
+
+
+# A sell first trades with the bids at or above its price, best bid first, and whatever is
+# left of it rests in the asks.
+async def processSellOrder(batch: Batch, sellOrder: RestingOrder):
     global sellTrees
 
-    transactionId = await stockFromSeller(sellOrder)
+    await ledger.reserveShares(
+        batch.session, sellOrder.user_id, sellOrder.stock_id, sellOrder.quantity
+    )
+    batch.onRollback(
+        ledger.adjustShares, sellOrder.user_id, sellOrder.stock_id, sellOrder.quantity
+    )
+
+    transactionId = await stockFromSeller(batch.session, sellOrder)
 
     sellOrder.stock_tx_id = transactionId
 
     if sellOrder.stock_tx_id is None:
         raise ValueError(400, "error assigned id to sell order")
 
-    heappush(sellTrees[sellOrder.stock_id], sellOrder)
+    await crossBook(batch, sellOrder, buyTrees[sellOrder.stock_id])
+    restOrder(batch, sellOrder)
+    batch.onOrder(sellOrder.stock_id, recordOf(sellOrder, placedStatus(sellOrder)))
 
 
-async def processBuyOrder(buyOrder: BuyOrder):
-    buyQueues[buyOrder.stock_id].append(buyOrder)
+# A limit buy pays for its whole quantity at its limit price up front, trades with the asks
+# at or below that price, best ask first, and whatever is left of it rests in the bids.
+async def processLimitBuyOrder(batch: Batch, buyOrder: RestingOrder):
+    reserved = buyOrder.price * buyOrder.quantity
+    await ledger.reserveCash(batch.session, buyOrder.user_id, reserved)
+    batch.onRollback(ledger.adjustCash, buyOrder.user_id, reserved)
 
-    await matchBuy(buyOrder)
+    transactionId = await fundsFromBuyer(batch.session, buyOrder)
 
+    buyOrder.stock_tx_id = transactionId
 
-# Matches buy orders to sell orders with partial buy handling
-# poppedSellOrders stores touples containing (sellOrder popped from heap, quantity sold)
-# return price of buy order
-async def matchBuy(buyOrder: BuyOrder):
-    global sellTrees
+    if buyOrder.stock_tx_id is None:
+        raise ValueError(400, "error assigned id to buy order")
 
-    tempTree = copy.deepcopy(sellTrees[buyOrder.stock_id])
-    skipped_orders = []
-    # returns a list of touples (SellOrderFilled, AmountSold)
-    try:
-        ordersFilled, newSellTree, skipped_orders = await matchBuyRecursive(
-            buyOrder, [], tempTree, skipped_orders
-        )
-    except ValueError as e:
-        raise e
-    finally:
-        for order in skipped_orders:
-            heappush(tempTree, order)
+    await crossBook(batch, buyOrder, sellTrees[buyOrder.stock_id])
+    restOrder(batch, buyOrder)
+    batch.onOrder(buyOrder.stock_id, recordOf(buyOrder, placedStatus(buyOrder)))
 
-    orderPrice = calculateMarketBuy(ordersFilled)
-    sellTrees[buyOrder.stock_id] = newSellTree
 
-    # takes money out of the buyers wallet
-    await fundsBuyerToSeller(buyOrder, ordersFilled, orderPrice)
+def placedStatus(order: RestingOrder):
+    if order.amount_sold == order.quantity:
+        return OrderStatus.COMPLETED.value
+    if order.amount_sold:
+        return OrderStatus.PARTIALLY_COMPLETE.value
+    return OrderStatus.IN_PROGRESS.value
 
 
-# This function tries to match up the buy order quantity with enough sell orders to match.
-# It may return any number of sell orders from <1 to N. Where any sell order can be
-# divided to match the quantity exactly (hence <1).
-# Divided orders operate accordingly:
-#   - Parent Order: quantity is reduced by the amount required to match the remining buy order balance. AND NOT REMOVED FROM THE HEAP
-#   - Child  Order: created with that same quantity to be added to the returned list of orders. It is never added to the heap
-#
-# Inputs:
-#           - @buyOrder : the buy order
-#           - @[]       : an empty list (for recursion) to populate with the returning sell orders
-#           - @tempTree : the heap for <stock_id> we are buying from
-# Outputs:
-#           - (SellOrderFilled, AmountSold) tuples
-#           - newSellTree
-# Errors:
-#           - 400
-#             -> ValueError(400, "transaction not in db")
-#             -> ValueError(400, "not enough sell volume to fill buy order")
-#
-async def matchBuyRecursive(
-    buyOrder: BuyOrder, poppedSellOrders: List, tempTree, skipped_orders
-):
+# Trades an incoming limit order with the other side of the book. Every trade happens at the
+# resting order's price. Both sides already paid (buys at their limit, sells with their stock)
+# when they were placed, so the fills only have to be queued for settlement.
+async def crossBook(batch: Batch, order: RestingOrder, book: OrderBook):
+    fills = book.match(order.user_id, order.quantity, limit=order.price)
+    if not fills:
+        return
+    batch.onRollback(book.rollback, fills)
 
-    if len(tempTree) == 0:
-        raise ValueError(400, "not enough sell volume to fill buy order")
+    for resting, quantity in fills:
+        order.amount_sold += quantity
+        batch.onFill(order, quantity, resting.price)
+        batch.onFill(resting, quantity, resting.price)
+        batch.onTrade(order.stock_id, resting.price, quantity)
 
-    ## check to make sure we aren't buying from ourselves
 
-    minSellOrder = heappop(tempTree)
+def restOrder(batch: Batch, order: RestingOrder):
+    if order.amount_sold == order.quantity:
+        return
 
-    if buyOrder.user_id == minSellOrder.user_id:
-        skipped_orders.append(minSellOrder)
-        return await matchBuyRecursive(
-            buyOrder, poppedSellOrders, tempTree, skipped_orders
-        )
-    """
-    having a while loop in a recursive function like this scares me 
-    changed the recursive handling to include a skipped orders list
-    skipped orders get added back after recursive step is over in matchBuy()
-    line 120
-    """
-    # while tempTree:
-    #
-    #     minSellOrder = heappop(tempTree)
-    #
-    #     if buyOrder.user_id == minSellOrder.user_id:
-    #         skipped_orders.append(minSellOrder)
-    #         continue
-    #     else:
-    #         break  # this line is hit when find a valid sell order which was not created by the buyer
-    #
-    # if (
-    #     not tempTree
-    #     and skipped_orders
-    #     and all(order.user_id == buyOrder.user_id for order in skipped_orders)
-    # ):
-    #     for order in skipped_orders:
-    #         heappush(tempTree, order)
-    #     raise ValueError(
-    #         400, "not enough sell orders from other users to fulfill order"
-    #     )
-    #
-    # for order in skipped_orders:
-    #     heappush(tempTree, order)
-    ## end check
-
-    buyQuantity = buyOrder.quantity
-    sellQuantity = minSellOrder.quantity
-    sellAmount = minSellOrder.amount_sold
-
-    # Case 1: sellOrder quantity == buyOrder quantity
-    if (sellQuantity - sellAmount) == buyQuantity:
-        minSellOrder.amount_sold = buyQuantity
-
-        poppedSellOrders.append((minSellOrder, buyQuantity))
-        return poppedSellOrders, tempTree, skipped_orders
-
-    # Case 2: sellOrder quantity > buyOrder quantity
-    #  (split off a child transaction)
-    if (sellQuantity - sellAmount) > buyQuantity:
-
-        # remove buy quantity from sell order
-        minSellOrder.amount_sold = sellAmount + buyQuantity
-
-        # change the original stock transaction to Partially complete
-        """
-         this is already getting updated somewhere else
-        """
-
-        # await setToPartiallyComplete(minSellOrder.stock_tx_id, minSellOrder.quantity)
-
-        # push original sell order back onto heap with reduced quantity
-        heappush(tempTree, minSellOrder)
-
-        # create a child sell order
-        childSellOrder = SellOrder(
-            stock_tx_id=minSellOrder.stock_tx_id,
-            user_id=minSellOrder.user_id,
-            stock_id=minSellOrder.stock_id,
-            quantity=buyQuantity,
-            price=minSellOrder.price,
-            timestamp=minSellOrder.timestamp,
-            order_type=minSellOrder.order_type,
-            amount_sold=buyQuantity,
-            is_child=True,
-        )
+    book = books[order.is_buy][order.stock_id]
+    book.add(order)
+    batch.onRollback(book.cancel, order)
+    # a rolled back order is left in the wheel; it is skipped when it comes due
+    if order.expires_at is not None:
+        wheel.schedule(order.expires_at, order)
 
-        # pass child sell order to dbConnect, no other need for it
-        poppedSellOrders.append((childSellOrder, buyQuantity))
-        # create a child transaction that is IN_PROGRESS, with the parent stock tx id
-
-        """
-         The transaction also gets created somewhere else and gets created as COMPLETE
-        """
-
-        # childTxId = await createChildTransaction(
-        #     childSellOrder, minSellOrder.stock_tx_id
-        # )
-        # childSellOrder.stock_tx_id = childTxId
-        #
-        # res = await getStockTransaction(childTxId)
-        #
-        # if not res:
-        #     raise ValueError(400, "transaction not in db")
-        """
-        child sell orders dont need to be added to the heap
-        """
-        # poppedSellOrders.append((childSellOrder, buyQuantity))
-
-        return poppedSellOrders, tempTree, skipped_orders
-
-    # Case 3: sellOrder quantity < buyOrder quantity
-    #  (we need more sell orders to make up the difference, so we recurse)
-    if (sellQuantity - sellAmount) < buyQuantity:
-
-        buyOrder.quantity = buyOrder.quantity - minSellOrder.quantity
-
-        minSellOrder.amount_sold = sellQuantity
-        poppedSellOrders.append((minSellOrder, minSellOrder.quantity))
-
-        return await matchBuyRecursive(
-            buyOrder, poppedSellOrders, tempTree, skipped_orders
-        )
+
+async def processBuyOrder(batch: Batch, buyOrder: BuyOrder):
+    await matchBuy(batch, buyOrder)
+
+
+# Matches buy orders to sell orders with partial buy handling
+# The book hands back (sellOrder, quantity sold) tuples for the orders it consumed. The sells
+# stay in the book (with amount_sold increased) until they are fully sold.
+#
+# Only the buyer's money is taken here, so the order can't go through without the funds. Moving
+# the shares and paying the sellers is queued for the settlement workers. The ledger is checked
+# before the wallet is touched; if either turns the buyer away the fills are put back into the
+# book, and they are registered with the batch so they are also put back if the batch fails to
+# commit.
+async def matchBuy(batch: Batch, buyOrder: BuyOrder):
+    global sellTrees
+
+    book = sellTrees[buyOrder.stock_id]
+    fills = book.match(buyOrder.user_id, buyOrder.quantity)
+    orderPrice = calculateMarketBuy(fills)
+
+    # takes money out of the buyers wallet
+    try:
+        await ledger.reserveCash(batch.session, buyOrder.user_id, orderPrice)
+        batch.onRollback(ledger.adjustCash, buyOrder.user_id, orderPrice)
+        await reserveMarketBuy(batch.session, buyOrder, orderPrice)
+    except Exception:
+        book.rollback(fills)
+        raise
+    batch.onRollback(book.rollback, fills)
+
+    batch.onMarketBuy(buyOrder, orderPrice)
+    batch.onOrder(
+        buyOrder.stock_id,
+        marketBuyRecord(
+            buyOrder, orderPrice // buyOrder.quantity, OrderStatus.COMPLETED.value
+        ),
+    )
+    for sellOrder, quantitySold in fills:
+        batch.onFill(sellOrder, quantitySold, sellOrder.price)
+        batch.onTrade(buyOrder.stock_id, sellOrder.price, quantitySold)
 
 
 def calculateMarketBuy(sellOrderList):
@@ -281,26 +701,91 @@ def calculateMarketBuy(sellOrderList):
     return price
 
 
-async def cancelOrderEngine(cancelOrder: CancelOrder, user_id: str):
+async def cancelOrderEngine(cancelOrder: CancelOrder, user_id: str, batch: Batch):
     transactionId = cancelOrder.stock_tx_id
-    # Search heap for order
 
-    transaction = await getStockTransaction(transactionId)
-    if not transaction:
-        raise ValueError(500, "transcation not found")
-    global sellTrees
+    sellOrder = orderIndex.get(transactionId)
+    # a cancel only runs on its own stock's actor, so it can't reach into another stock's book
+    if sellOrder is None or cancelOrder.stock_id not in (None, sellOrder.stock_id):
+        raise ValueError(404, "order not found or already completed")
 
-    tree = sellTrees[transaction.stock_id]
+    if sellOrder.user_id != user_id:
+        raise ValueError(500, "you cannot cancel an order that is not yours")
 
-    for sellOrder in tree:
-        if sellOrder.stock_tx_id == transactionId:
-            if sellOrder.user_id != user_id:
-                raise ValueError(500, "you cannot cancel an order that is not yours")
-            else:
-                tree.remove(sellOrder)
-                heapify(tree)
-                break
+    book = books[sellOrder.is_buy][sellOrder.stock_id]
+    book.cancel(sellOrder)
+
+    # set transaction status to cancelled and return the unsold stock
+    unsold = sellOrder.quantity - sellOrder.amount_sold
+    try:
+        await cancelTransaction(batch.session, transactionId, unsold)
+    except Exception:
+        book.restore(sellOrder)
+        raise
+    batch.onRollback(book.restore, sellOrder)
+
+    if sellOrder.is_buy:
+        ledger.adjustCash(user_id, sellOrder.price * unsold)
+        batch.onRollback(ledger.adjustCash, user_id, -sellOrder.price * unsold)
+    else:
+        ledger.adjustShares(user_id, sellOrder.stock_id, unsold)
+        batch.onRollback(ledger.adjustShares, user_id, sellOrder.stock_id, -unsold)
 
-    # set transaction status to cancelled
-    await cancelTransaction(transactionId)
+    batch.onOrder(sellOrder.stock_id, recordOf(sellOrder, OrderStatus.CANCELLED.value))
     return SuccessResponse()
+
+
+# Moves the wheel on to <now> and queues the orders that have expired and are still resting
+# for their stock's actor.
+#
+# Outputs:
+#           - the stocks with orders waiting to expire
+def collectExpired(now: float):
+    for order in wheel.advance(int(now)):
+        if orderIndex.get(order.stock_tx_id) is order:
+            pendingExpiry[order.stock_id].append(order)
+    return [stock_id for stock_id, orders in pendingExpiry.items() if orders]
+
+
+# Up to <limit> of the orders waiting to expire on <stock_id>, oldest first
+def takeExpiring(stock_id: int, limit: int):
+    orders = pendingExpiry[stock_id]
+    taken = [orders.popleft() for _ in range(min(limit, len(orders)))]
+    if not orders:
+        del pendingExpiry[stock_id]
+    return taken
+
+
+def requeueExpiring(orders):
+    for order in reversed(orders):
+        pendingExpiry[order.stock_id].appendleft(order)
+
+
+# Cancels expired orders the way cancelOrderEngine cancels one, but with the database work for
+# all of them done together (see expireTransactions). Runs on their stock's actor; orders that
+# were filled or cancelled since they were taken are skipped, and if the batch rolls back the
+# rest go back to wait for the next run.
+async def expireOrdersEngine(orders, batch: Batch):
+    live = [order for order in orders if orderIndex.get(order.stock_tx_id) is order]
+    batch.onRollback(requeueExpiring, live)
+
+    for order in live:
+        book = books[order.is_buy][order.stock_id]
+        book.cancel(order)
+        batch.onRollback(book.restore, order)
+
+    await expireTransactions(batch.session, live)
+
+    for order in live:
+        unsold = order.quantity - order.amount_sold
+        if order.is_buy:
+            ledger.adjustCash(order.user_id, order.price * unsold)
+            batch.onRollback(ledger.adjustCash, order.user_id, -order.price * unsold)
+        else:
+            ledger.adjustShares(order.user_id, order.stock_id, unsold)
+            batch.onRollback(
+                ledger.adjustShares, order.user_id, order.stock_id, -unsold
+            )
+        batch.onOrder(order.stock_id, recordOf(order, OrderStatus.CANCELLED.value))
+
+    return SuccessResponse(data={"expired": len(live)})
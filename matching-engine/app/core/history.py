@@ -0,0 +1,81 @@
+import os
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+# recent orders kept per stock; older ones are dropped
+HISTORY_SIZE = int(os.getenv("ENGINE_HISTORY_SIZE") or 1000)
+
+
+class OrderRecord(NamedTuple):
+    timestamp: float
+    stock_tx_id: Optional[int]
+    user_id: str
+    is_buy: bool
+    order_type: str
+    # limit price, or the average price paid for a market buy
+    price: Optional[int]
+    quantity: int
+    filled: int
+    status: str
+
+
+def recordOf(order, status: str):
+    return OrderRecord(
+        timestamp=time.time(),
+        stock_tx_id=order.stock_tx_id,
+        user_id=order.user_id,
+        is_buy=order.is_buy,
+        order_type=order.order_type,
+        price=order.price,
+        quantity=order.quantity,
+        filled=order.amount_sold,
+        status=status,
+    )
+
+
+def marketBuyRecord(buyOrder, price: int, status: str):
+    return OrderRecord(
+        timestamp=time.time(),
+        stock_tx_id=None,
+        user_id=buyOrder.user_id,
+        is_buy=True,
+        order_type=buyOrder.order_type,
+        price=price,
+        quantity=buyOrder.quantity,
+        filled=buyOrder.quantity,
+        status=status,
+    )
+
+
+class OrderHistory:
+    """The last ``size`` orders placed or cancelled on each stock, newest last.
+
+    Each stock has a ring buffer (a deque with a maxlen), so once it is full every new record
+    pushes out the oldest one and the history stays the same size however long the engine runs.
+    Records are plain tuples and hold no reference to the orders in the books, so filled orders
+    can be freed as soon as they leave the book.
+    """
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        self.size = size
+        self.stocks = {}
+
+    def __len__(self):
+        return sum(len(records) for records in self.stocks.values())
+
+    def record(self, stock_id: int, record: OrderRecord):
+        records = self.stocks.get(stock_id)
+        if records is None:
+            records = self.stocks[stock_id] = deque(maxlen=self.size)
+        records.append(record)
+
+    # Up to <limit> of <user_id>'s most recent orders on <stock_id>, newest first
+    def recent(self, stock_id: int, user_id: str, limit: int):
+        found = []
+        for record in reversed(self.stocks.get(stock_id, ())):
+            if record.user_id == user_id:
+                found.append(record)
+                if len(found) == limit:
+                    break
+        return found
@@ -0,0 +1,103 @@
+import os
+import time
+
+# How long a balance the ledger says is too low is trusted before it is read again from the
+# database, for money or stock that arrived from outside the engine (add_money, new holdings,
+# settled fills)
+LEDGER_REFRESH_SECONDS = float(os.getenv("LEDGER_REFRESH_SECONDS") or 1)
+
+
+class RiskLedger:
+    """The cash and shares each account has available to new orders, kept in memory.
+
+    Hydrated from the wallets and portfolios when the engine starts, then kept up to date with
+    what the engine does: ``reserveCash`` and ``reserveShares`` take from it when an order is
+    placed, before any database work, so an order that can't be paid for is rejected without a
+    query. ``adjustCash`` and ``adjustShares`` give back (or, to undo a change, take back) what
+    a cancel or a rolled back order returns.
+
+    Fills are not credited here: the settlement workers apply them to the wallets and
+    portfolios later, and until they do the database won't let the proceeds be spent. So the
+    ledger never offers more than the database holds.
+
+    An account the ledger hasn't seen is loaded with ``loadCash(session, user_id)`` or
+    ``loadShares(session, user_id, stock_id)`` on first use. A balance that is too low is read
+    again at most every LEDGER_REFRESH_SECONDS, to pick up settled fills, deposits and stock
+    added outside the engine. Changes to an account that isn't loaded yet are left to that first read. Either
+    read goes through the batch's session, so it includes what the batch has already written.
+
+    The database writes behind each order still check the balances. With more than one
+    partition every engine sees all of a user's cash but only its own orders' use of it, so
+    that check is what stops the same money being spent twice across partitions.
+    """
+
+    def __init__(self, loadCash, loadShares):
+        self.loadCash = loadCash
+        self.loadShares = loadShares
+        # user_id -> cash
+        self.cash = {}
+        # (user_id, stock_id) -> shares
+        self.shares = {}
+        # user_id or (user_id, stock_id) -> time.monotonic() it was last read from the database
+        self.loaded = {}
+
+    def hydrate(self, wallets, holdings):
+        now = time.monotonic()
+        for user_id, balance in wallets:
+            self.cash[user_id] = balance
+            self.loaded[user_id] = now
+        for user_id, stock_id, quantity in holdings:
+            self.shares[(user_id, stock_id)] = quantity
+            self.loaded[(user_id, stock_id)] = now
+
+    def stale(self, key):
+        return time.monotonic() - self.loaded.get(key, float("-inf")) >= (
+            LEDGER_REFRESH_SECONDS
+        )
+
+    # Sets <table>[<key>] to what <read> returns. Other stocks' batches keep going while it
+    # reads, so what they reserve from the old value in the meantime is carried over, and if
+    # one of them loaded the key first its value is kept.
+    async def load(self, table, key, read):
+        before = table.get(key)
+        value = await read
+        if value is None or (before is None and key in table):
+            return
+
+        table[key] = value + (table[key] - before if before is not None else 0)
+        self.loaded[key] = time.monotonic()
+
+    async def reserveCash(self, session, user_id: str, amount: int):
+        if amount <= 0:
+            raise ValueError(400, "Amount is 0")
+
+        if user_id not in self.cash or (
+            self.cash[user_id] < amount and self.stale(user_id)
+        ):
+            await self.load(self.cash, user_id, self.loadCash(session, user_id))
+            if user_id not in self.cash:
+                raise ValueError(400, "No wallet found")
+
+        if self.cash[user_id] < amount:
+            raise ValueError(400, "Buyer lacks funds")
+        self.cash[user_id] -= amount
+
+    async def reserveShares(self, session, user_id: str, stock_id: int, quantity: int):
+        key = (user_id, stock_id)
+        if key not in self.shares or (self.shares[key] < quantity and self.stale(key)):
+            await self.load(
+                self.shares, key, self.loadShares(session, user_id, stock_id)
+            )
+
+        if self.shares[key] < quantity:
+            raise ValueError(400, "Seller lacks the stocks for this order")
+        self.shares[key] -= quantity
+
+    def adjustCash(self, user_id: str, amount: int):
+        if user_id in self.cash:
+            self.cash[user_id] += amount
+
+    def adjustShares(self, user_id: str, stock_id: int, quantity: int):
+        key = (user_id, stock_id)
+        if key in self.shares:
+            self.shares[key] += quantity
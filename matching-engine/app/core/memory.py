@@ -0,0 +1,82 @@
+import os
+import sys
+
+# cgroup v2 files first, then v1
+CGROUP_LIMIT_FILES = (
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+)
+CGROUP_USAGE_FILES = (
+    "/sys/fs/cgroup/memory.current",
+    "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+)
+
+# cgroup v1 reports "no limit" as a huge number rather than "max"
+NO_LIMIT = 1 << 60
+
+
+def readCgroupValue(paths):
+    for path in paths:
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        if value == "max" or int(value) >= NO_LIMIT:
+            return None
+        return int(value)
+    return None
+
+
+# The container's memory limit in bytes, or None when it has none (or isn't in a container)
+def containerLimit():
+    return readCgroupValue(CGROUP_LIMIT_FILES)
+
+
+# What the container is charged for, page cache included, which is what the limit applies to
+def containerUsage():
+    return readCgroupValue(CGROUP_USAGE_FILES)
+
+
+def processRss():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+# Approximate bytes held by the books on both sides: the level dicts and sorted price lists,
+# every level with its queue and per-user totals, and every order still in a queue (lazily
+# deleted ones included). User ids are interned and shared, so they aren't counted per order.
+def booksBytes(books, orderSize: int):
+    total = 0
+    for side in books:
+        total += sys.getsizeof(side)
+        for book in side.values():
+            total += sys.getsizeof(book.levels) + sys.getsizeof(book.keys)
+            total += sys.getsizeof(book.owned)
+            for level in book.levels.values():
+                total += sys.getsizeof(level) + sys.getsizeof(level.orders)
+                total += sys.getsizeof(level.owned)
+                total += len(level.orders) * orderSize
+    return total
+
+
+def historyBytes(history, recordSize: int):
+    total = sys.getsizeof(history.stocks)
+    for records in history.stocks.values():
+        total += sys.getsizeof(records) + len(records) * recordSize
+    return total
+
+
+# The shares and refresh times share their (user_id, stock_id) keys, so those are counted once
+def ledgerBytes(ledger):
+    entries = len(ledger.cash) + len(ledger.shares)
+    return (
+        sys.getsizeof(ledger.cash)
+        + sys.getsizeof(ledger.shares)
+        + sys.getsizeof(ledger.loaded)
+        + len(ledger.shares) * sys.getsizeof(("", 0))
+        + entries * (sys.getsizeof(1 << 40) + sys.getsizeof(0.0))
+    )
@@ -0,0 +1,156 @@
+import asyncio
+import math
+from contextlib import contextmanager
+from time import perf_counter
+
+# Histogram buckets are log spaced: BUCKETS_PER_DOUBLING per power of two from MIN_BOUND
+# seconds, so any latency from 1us to a couple of minutes lands in a bucket at most ~19% wide
+# and a quantile read from them is within about that of the real value
+MIN_BOUND = 1e-6
+BUCKETS_PER_DOUBLING = 4
+BUCKET_COUNT = 27 * BUCKETS_PER_DOUBLING
+BOUNDS = [MIN_BOUND * 2 ** (i / BUCKETS_PER_DOUBLING) for i in range(BUCKET_COUNT)]
+
+
+class LatencyHistogram:
+    """Counts of observed latencies in fixed log-spaced buckets (see BOUNDS), plus their sum.
+
+    ``observe`` is a log and an increment, and the memory is fixed however many values are
+    observed. The last count is for values above the top bound.
+    """
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (BUCKET_COUNT + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        if seconds <= MIN_BOUND:
+            bucket = 0
+        else:
+            bucket = min(
+                math.ceil(math.log2(seconds / MIN_BOUND) * BUCKETS_PER_DOUBLING - 1e-9),
+                BUCKET_COUNT,
+            )
+        self.counts[bucket] += 1
+        self.sum += seconds
+        self.count += 1
+
+    # The upper bound of the bucket holding the <q> quantile, or None if nothing was observed
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BOUNDS[bucket] if bucket < BUCKET_COUNT else math.inf
+        return math.inf
+
+
+class Metrics:
+    """Latency histograms by metric name and labels, rendered in the Prometheus text format.
+
+    A histogram is created the first time its name and labels are observed, e.g.
+    ``metrics.observe("settlement_stage_seconds", 0.002, stage="commit")``, or timed with
+    ``with metrics.timer(...)``. Metrics kept elsewhere are added with ``collect``.
+    """
+
+    def __init__(self):
+        # name -> help text
+        self.help = {}
+        # (name, ((label, value), ...)) -> LatencyHistogram
+        self.histograms = {}
+        # functions returning more metrics in the text format, called on every render
+        self.collectors = []
+
+    def describe(self, name: str, help: str):
+        self.help[name] = help
+
+    def histogram(self, name: str, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        return histogram
+
+    def collect(self, collector):
+        self.collectors.append(collector)
+
+    def observe(self, name: str, seconds: float, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    # Observes how long the block takes, whether or not it raises
+    @contextmanager
+    def timer(self, name: str, **labels):
+        histogram = self.histogram(name, **labels)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(perf_counter() - start)
+
+    def render(self):
+        lines = []
+        described = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+
+            labelText = ",".join(f'{label}="{value}"' for label, value in labels)
+            prefix = labelText + "," if labelText else ""
+
+            cumulative = 0
+            for bound, count in zip(BOUNDS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labelText}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labelText}}} {histogram.count}")
+        text = "\n".join(lines) + "\n" if lines else ""
+        return text + "".join(collector() for collector in self.collectors)
+
+
+metrics = Metrics()
+
+
+# Answers GET /metrics with the rendered histograms and anything else with a 404. Plain
+# HTTP/1.0 over asyncio streams, one request per connection, which is all a scraper needs.
+async def handleScrape(reader, writer):
+    try:
+        requestLine = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = requestLine.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status = b"200 OK"
+            body = metrics.render().encode()
+        else:
+            status = b"404 Not Found"
+            body = b"not found\n"
+
+        writer.write(
+            b"HTTP/1.0 " + status + b"\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+# Serves the metrics on <port> until the process exits; a port of 0 turns them off
+async def serveMetrics(port: int):
+    if not port:
+        return None
+    return await asyncio.start_server(handleScrape, "0.0.0.0", port)
@@ -0,0 +1,354 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+
+class PriceLevel:
+    """All resting orders at one price, oldest first, with their combined unfilled quantity.
+
+    ``owned`` holds the unfilled quantity per user so an incoming order can step over a level
+    made up only of its own user's orders without looking at it.
+
+    Cancelled and filled orders are deleted lazily: they stay in ``orders`` until they reach
+    the front of the queue, but are no longer counted in ``quantity``, ``owned`` or ``count``.
+    """
+
+    __slots__ = ("price", "orders", "quantity", "owned", "count")
+
+    def __init__(self, price: int):
+        self.price = price
+        self.orders = deque()
+        self.quantity = 0
+        self.owned = {}
+        self.count = 0
+
+
+class RestingOrder:
+    """An order as the engine keeps it in a book: a sell, or a limit buy.
+
+    ``seq`` comes from a counter in the engine and decides time priority within a price level.
+    ``expires_at`` is when a DAY or GTT order leaves the book (seconds since the epoch), or
+    None for an order that rests until it is filled or cancelled.
+    """
+
+    __slots__ = (
+        "stock_tx_id",
+        "user_id",
+        "stock_id",
+        "price",
+        "quantity",
+        "amount_sold",
+        "seq",
+        "order_type",
+        "is_buy",
+        "expires_at",
+    )
+
+    # keyword arguments everywhere but loading a snapshot, which builds millions of them
+    def __init__(
+        self,
+        stock_tx_id,
+        user_id: str,
+        stock_id: int,
+        price: int,
+        quantity: int,
+        amount_sold: int,
+        seq: int,
+        order_type: str,
+        is_buy: bool = False,
+        expires_at: int = None,
+    ):
+        self.stock_tx_id = stock_tx_id
+        self.user_id = user_id
+        self.stock_id = stock_id
+        self.price = price
+        self.quantity = quantity
+        self.amount_sold = amount_sold
+        self.seq = seq
+        self.order_type = order_type
+        self.is_buy = is_buy
+        self.expires_at = expires_at
+
+
+def remaining(order):
+    return order.quantity - order.amount_sold
+
+
+# One side of the book for a single stock: the asks (resting sells), or with is_buy the bids
+# (resting limit buys).
+#
+# Orders are grouped into PriceLevels keyed by price. The prices that have a level are kept
+# in a sorted list, negated for asks, so the best price (lowest ask or highest bid) is always
+# the last element and exhausting the top of the book is a list pop rather than a shift.
+#
+# <index> maps stock_tx_id -> order for every live order. It is shared between the books of
+# all stocks so an order can be found from its id alone; an order is live only while the
+# index points at it, which is what lets cancels and fills skip touching the queues.
+#
+# <owned> holds the unfilled quantity resting in the book per user, so an order that can only
+# be filled by trading with yourself is turned away without walking the book.
+#
+# <journal>, when set, is told about every change to the book (see persistence.py) so the book
+# can be rebuilt after a restart.
+#
+# <listener>, when set, has changed(book, order) called after every change to the book's
+# volume or prices (see prices.py).
+#
+# An incoming order only walks the levels it actually consumes; nothing is copied.
+class OrderBook:
+    def __init__(self, index=None, journal=None, is_buy=False, listener=None):
+        self.index = {} if index is None else index
+        self.journal = journal
+        self.listener = listener
+        self.is_buy = is_buy
+        # sort key of a price: best price last
+        self.sign = 1 if is_buy else -1
+        self.levels = {}
+        self.keys = []
+        self.quantity = 0
+        self.owned = {}
+        self.count = 0
+
+    def __bool__(self):
+        return bool(self.keys)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for level in self.levels.values():
+            for order in level.orders:
+                if self.is_live(order):
+                    yield order
+
+    def is_live(self, order):
+        return self.index.get(order.stock_tx_id) is order
+
+    def available_to(self, user_id: str):
+        return self.quantity - self.owned.get(user_id, 0)
+
+    def best_price(self):
+        if not self.keys:
+            return None
+        return self.sign * self.keys[-1]
+
+    # (price, unfilled quantity, order count) of the best <levels> price levels, best first.
+    # Reads the per-level counters only; the orders themselves aren't looked at.
+    def depth(self, levels: int):
+        depth = []
+        for key in self.keys[: -levels - 1 : -1]:
+            level = self.levels[self.sign * key]
+            depth.append((level.price, level.quantity, level.count))
+        return depth
+
+    def add(self, order):
+        level = self._level(order.price)
+        level.orders.append(order)
+        self._link(level, order)
+
+        if self.journal:
+            self.journal.add(order)
+        if self.listener:
+            self.listener.changed(self, order)
+
+    # Appends orders that all rest at <price>, oldest first, without journalling them.
+    # Used to load books in bulk.
+    def extend(self, price: int, orders):
+        level = self._level(price)
+        level.orders.extend(orders)
+
+        # _adjust for every order, inlined: a restore runs this for millions of them. Loaded
+        # orders all have something left, so no user's count drops to zero here.
+        index = self.index
+        levelOwned = level.owned
+        bookOwned = self.owned
+        added = 0
+        for order in orders:
+            index[order.stock_tx_id] = order
+            user_id = order.user_id
+            quantity = order.quantity - order.amount_sold
+            levelOwned[user_id] = levelOwned.get(user_id, 0) + quantity
+            bookOwned[user_id] = bookOwned.get(user_id, 0) + quantity
+            added += quantity
+
+        level.quantity += added
+        self.quantity += added
+        level.count += len(orders)
+        self.count += len(orders)
+
+        if self.listener:
+            self.listener.changed(self, orders[0])
+
+    # Takes a live order out of the book in O(1). Its queue entry is dropped later.
+    def cancel(self, order):
+        if self.journal:
+            self.journal.cancel(order)
+
+        level = self.levels[order.price]
+        self._unlink(level, order, remaining(order))
+
+        if level.count == 0:
+            self._drop_level(level)
+        elif len(level.orders) > 2 * level.count + 32:
+            level.orders = deque(o for o in level.orders if self.is_live(o))
+
+        if self.listener:
+            self.listener.changed(self, order)
+
+    # Puts a cancelled or filled order back at its original place in the queue,
+    # e.g. when the database update for it fails.
+    def restore(self, order):
+        if self.journal:
+            self.journal.restore(order)
+
+        level = self._level(order.price)
+        if not any(resting is order for resting in level.orders):
+            index = 0
+            for resting in level.orders:
+                if order.seq < resting.seq:
+                    break
+                index += 1
+            level.orders.insert(index, order)
+
+        self._link(level, order)
+
+        if self.listener:
+            self.listener.changed(self, order)
+
+    # Raises if a buy of <quantity> by <user_id> can't be filled, using only the counters
+    def check(self, user_id: str, quantity: int):
+        if self.quantity < quantity:
+            raise ValueError(400, "not enough sell volume to fill buy order")
+
+        if self.available_to(user_id) < quantity:
+            raise ValueError(
+                400, "not enough sell orders from other users to fulfill order"
+            )
+
+    # Finds volume to fill <quantity>, ignoring orders owned by <user_id>, and takes it from
+    # the book. Levels that only hold <user_id>'s orders are skipped without being read, and
+    # the user's orders inside a level are stepped over rather than taken out.
+    #
+    # Without a <limit> the whole quantity has to be filled (a market buy against the asks).
+    # With one, only levels priced at or better than <limit> are used (at most <limit> for
+    # asks, at least <limit> for bids) and the fills may come to less than <quantity>.
+    #
+    # Outputs:
+    #           - list of (restingOrder, quantityFilled) tuples in price-time priority
+    # Errors (without a limit):
+    #           - ValueError(400, "not enough sell volume to fill buy order")
+    #           - ValueError(400, "not enough sell orders from other users to fulfill order")
+    #             both are raised before the book is read, and leave it untouched
+    def match(self, user_id: str, quantity: int, limit: int = None):
+        if limit is None:
+            self.check(user_id, quantity)
+            worst = None
+        else:
+            worst = self.sign * limit
+
+        fills = []
+        needed = quantity
+
+        for key in reversed(self.keys):
+            if worst is not None and key < worst:
+                break
+
+            level = self.levels[self.sign * key]
+            if level.owned.get(user_id, 0) == level.quantity:
+                continue
+
+            for order in level.orders:
+                if order.user_id == user_id or not self.is_live(order):
+                    continue
+
+                taken = min(remaining(order), needed)
+                fills.append((order, taken))
+                needed -= taken
+                if needed == 0:
+                    break
+
+            if needed == 0:
+                break
+
+        for order, taken in fills:
+            self.fill(order, taken)
+
+        return fills
+
+    # Fills <quantity> of a live order, taking it out of the book once it is filled.
+    # A negative quantity puts back part of an earlier fill.
+    def fill(self, order, quantity: int):
+        if self.journal:
+            self.journal.fill(order, quantity)
+
+        level = self.levels[order.price]
+        order.amount_sold += quantity
+
+        if remaining(order) == 0:
+            self._unlink(level, order, quantity)
+        else:
+            self._adjust(level, order.user_id, -quantity)
+
+        self._drop_dead(level)
+
+        if self.listener:
+            self.listener.changed(self, order)
+
+    # Puts back fills returned by match(), e.g. when settlement fails.
+    def rollback(self, fills):
+        for order, taken in reversed(fills):
+            if self.is_live(order):
+                self.fill(order, -taken)
+            else:
+                order.amount_sold -= taken
+                self.restore(order)
+
+    def _level(self, price: int):
+        level = self.levels.get(price)
+        if level is None:
+            level = self.levels[price] = PriceLevel(price)
+            insort(self.keys, self.sign * price)
+        return level
+
+    def _link(self, level: PriceLevel, order):
+        self.index[order.stock_tx_id] = order
+        self._adjust(level, order.user_id, remaining(order))
+        level.count += 1
+        self.count += 1
+
+    def _unlink(self, level: PriceLevel, order, quantity: int):
+        del self.index[order.stock_tx_id]
+        self._adjust(level, order.user_id, -quantity)
+        level.count -= 1
+        self.count -= 1
+
+    def _adjust(self, level: PriceLevel, user_id: str, quantity: int):
+        level.quantity += quantity
+        self.quantity += quantity
+
+        owned = level.owned
+        total = owned.get(user_id, 0) + quantity
+        if total:
+            owned[user_id] = total
+        else:
+            del owned[user_id]
+
+        owned = self.owned
+        total = owned.get(user_id, 0) + quantity
+        if total:
+            owned[user_id] = total
+        else:
+            del owned[user_id]
+
+    def _drop_dead(self, level: PriceLevel):
+        if level.count == 0:
+            self._drop_level(level)
+            return
+
+        orders = level.orders
+        while not self.is_live(orders[0]):
+            orders.popleft()
+
+    def _drop_level(self, level: PriceLevel):
+        if self.levels.get(level.price) is level:
+            del self.levels[level.price]
+            del self.keys[bisect_left(self.keys, self.sign * level.price)]
@@ -0,0 +1,397 @@
+import contextvars
+import gc
+import os
+import struct
+import sys
+from contextlib import contextmanager
+from .orderbook import RestingOrder
+
+# Books are persisted as a binary snapshot plus an append-only journal of every change made
+# since that snapshot. Restoring is loading the snapshot and replaying the journal on top.
+#
+#   <dir>/snapshot-<partition>.bin
+#       header, the user ids referenced by the orders, then one fixed size record per
+#       resting order in queue order
+#   <dir>/journal-<partition>-<generation>.bin
+#       (op, payload) records. A snapshot stores the journal generation that was started
+#       when it was taken, and only journals from that generation on are replayed over it.
+#       The engine writes each batch's records as one block, numbered within the generation,
+#       just before the batch commits, and the commit records (generation, number) in the
+#       journalcommits table; only the blocks recorded there are replayed, so a batch that
+#       didn't commit leaves nothing behind and one that did is always on disk.
+#
+# Snapshots are written by a forked child, so the engine keeps matching against its own copy
+# of the books while the child serializes the frozen one.
+#
+# <books> is always the pair (asks, bids) of stock_id -> OrderBook mappings, so the book an
+# order belongs to is books[order.is_buy][order.stock_id].
+
+FORMAT_VERSION = 5
+SNAPSHOT_MAGIC = b"MESN"
+
+# magic, version, partition, partitions, journal generation, user count, order count
+SNAPSHOT_HEADER = struct.Struct("<4sBIIQIQ")
+USER_ID_LENGTH = struct.Struct("<B")
+
+# stock_tx_id, stock_id, price, quantity, amount_sold, seq, expires_at (0 for none),
+# user (index into the user table in snapshots, id length in journals), flags
+ORDER = struct.Struct("<qqqqqqqIB")
+LIMIT, BUY = 1, 2
+
+JOURNAL_OP = struct.Struct("<B")
+JOURNAL_FILL = struct.Struct("<qq")
+JOURNAL_CANCEL = struct.Struct("<q")
+# batch number, length of the records that follow
+JOURNAL_BATCH = struct.Struct("<IQ")
+ADD, RESTORE, FILL, CANCEL, BATCH = 1, 2, 3, 4, 5
+
+
+def packOrder(order, user: int):
+    return ORDER.pack(
+        order.stock_tx_id,
+        order.stock_id,
+        order.price,
+        order.quantity,
+        order.amount_sold,
+        order.seq,
+        order.expires_at or 0,
+        user,
+        (LIMIT if order.order_type == "LIMIT" else 0) | (BUY if order.is_buy else 0),
+    )
+
+
+def unpackOrder(fields, user_id: str):
+    stockTxId, stockId, price, quantity, amountSold, seq, expiresAt, _, flags = fields
+    return RestingOrder(
+        stock_tx_id=stockTxId,
+        user_id=user_id,
+        stock_id=stockId,
+        price=price,
+        quantity=quantity,
+        amount_sold=amountSold,
+        seq=seq,
+        order_type="LIMIT" if flags & LIMIT else "MARKET",
+        is_buy=bool(flags & BUY),
+        expires_at=expiresAt or None,
+    )
+
+
+class Journal:
+    """Append-only record of book changes.
+
+    Changes made inside ``batch()`` are held back and written as one block by ``commit``;
+    any others are written straight away, buffered until ``flush()``.
+    """
+
+    def __init__(self, directory: str, partition: int, fsync: bool = False):
+        self.directory = directory
+        self.partition = partition
+        self.fsync = fsync
+        self.generation = 0
+        self.file = None
+        # blocks written in the current generation
+        self.batches = 0
+        # the running batch's records, per task
+        self.pending = contextvars.ContextVar(f"journal-{partition}", default=None)
+
+    def path(self, generation: int):
+        return os.path.join(
+            self.directory, f"journal-{self.partition}-{generation}.bin"
+        )
+
+    def generations(self):
+        prefix = f"journal-{self.partition}-"
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(".bin"):
+                found.append(int(name[len(prefix) : -len(".bin")]))
+        return sorted(found)
+
+    # Starts writing to a new generation after every existing one
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.generation = max(self.generations(), default=-1) + 1
+        self.batches = 0
+        self.file = open(self.path(self.generation), "ab")
+
+    def rotate(self):
+        self.flush()
+        self.file.close()
+        self.generation += 1
+        self.batches = 0
+        self.file = open(self.path(self.generation), "ab")
+
+    # Deletes the journals that a snapshot taken at <generation> already covers
+    def prune(self, generation: int):
+        for old in self.generations():
+            if old < generation:
+                os.remove(self.path(old))
+
+    def flush(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    # Holds back the changes the current task makes until commit(), so a batch's records are
+    # written together once it is about to commit, and never if it fails first
+    @contextmanager
+    def batch(self):
+        records = bytearray()
+        token = self.pending.set(records)
+        try:
+            yield records
+        finally:
+            self.pending.reset(token)
+
+    # Writes a batch's <records> as the next block and flushes it. Returns the block's
+    # (generation, number) for the batch's transaction to record, or None if it has no records.
+    def commit(self, records):
+        if self.file is None or not records:
+            return None
+        self.batches += 1
+        self.file.write(
+            JOURNAL_OP.pack(BATCH) + JOURNAL_BATCH.pack(self.batches, len(records))
+        )
+        self.file.write(records)
+        records.clear()
+        self.flush()
+        return self.generation, self.batches
+
+    # The book calls these as it changes. Nothing is written while the books are being
+    # restored, because the journal isn't open yet.
+
+    def add(self, order):
+        self._writeOrder(ADD, order)
+
+    def restore(self, order):
+        self._writeOrder(RESTORE, order)
+
+    def fill(self, order, quantity: int):
+        self._write(
+            JOURNAL_OP.pack(FILL) + JOURNAL_FILL.pack(order.stock_tx_id, quantity)
+        )
+
+    def cancel(self, order):
+        self._write(JOURNAL_OP.pack(CANCEL) + JOURNAL_CANCEL.pack(order.stock_tx_id))
+
+    def _writeOrder(self, op: int, order):
+        if self.file is None:
+            return
+        userId = order.user_id.encode()
+        self._write(JOURNAL_OP.pack(op) + packOrder(order, len(userId)) + userId)
+
+    def _write(self, record: bytes):
+        if self.file is None:
+            return
+        records = self.pending.get()
+        if records is None:
+            self.file.write(record)
+        else:
+            records += record
+
+
+def snapshotPath(directory: str, partition: int):
+    return os.path.join(directory, f"snapshot-{partition}.bin")
+
+
+def writeSnapshot(books, directory, partition, partitions, generation):
+    users = {}
+    body = bytearray()
+    count = 0
+    for side in books:
+        for book in side.values():
+            for order in book:
+                user = users.get(order.user_id)
+                if user is None:
+                    user = users[order.user_id] = len(users)
+                body += packOrder(order, user)
+                count += 1
+
+    path = snapshotPath(directory, partition)
+    with open(path + ".tmp", "wb") as file:
+        file.write(
+            SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC,
+                FORMAT_VERSION,
+                partition,
+                partitions,
+                generation,
+                len(users),
+                count,
+            )
+        )
+        for userId in users:
+            encoded = userId.encode()
+            file.write(USER_ID_LENGTH.pack(len(encoded)) + encoded)
+        file.write(body)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+    return count
+
+
+# Forks a child that writes the snapshot and exits; returns its pid and the snapshot's generation.
+# The journal moves to a new generation first, so everything written from here on is replayed
+# over this snapshot.
+def forkSnapshot(books, journal: Journal, partitions):
+    journal.rotate()
+    generation = journal.generation
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            writeSnapshot(
+                books, journal.directory, journal.partition, partitions, generation
+            )
+            os._exit(0)
+        except BaseException:
+            os._exit(1)
+    return pid, generation
+
+
+# Loads the snapshot and journals into <books>. Returns the journal generation of the snapshot,
+# or None if there is no usable snapshot for this partition layout.
+#
+# <committed> is the (generation, number) of every journal block whose batch committed (see
+# Journal.commit); the others are skipped. None replays every block.
+def loadBooks(books, index, journal: Journal, partitions, committed=None):
+    # millions of new objects and none of them garbage; don't let the collector rescan them
+    gc.disable()
+    try:
+        return _loadBooks(books, index, journal, partitions, committed)
+    finally:
+        gc.enable()
+        gc.freeze()
+
+
+def _loadBooks(books, index, journal: Journal, partitions, committed):
+    path = snapshotPath(journal.directory, journal.partition)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as file:
+        data = file.read()
+
+    magic, version, partition, snapshotPartitions, generation, userCount, orderCount = (
+        SNAPSHOT_HEADER.unpack_from(data)
+    )
+    if (
+        magic != SNAPSHOT_MAGIC
+        or version != FORMAT_VERSION
+        or partition != journal.partition
+        or snapshotPartitions != partitions
+    ):
+        return None
+
+    offset = SNAPSHOT_HEADER.size
+    users = []
+    for _ in range(userCount):
+        (length,) = USER_ID_LENGTH.unpack_from(data, offset)
+        offset += USER_ID_LENGTH.size
+        users.append(sys.intern(data[offset : offset + length].decode()))
+        offset += length
+
+    # records for one price level are contiguous, so they are loaded a level at a time. This
+    # is most of a restore's time, so the records are unpacked here rather than by unpackOrder.
+    end = offset + orderCount * ORDER.size
+    run = []
+    runStock = runPrice = runBuy = None
+    for (
+        stockTxId,
+        stockId,
+        price,
+        quantity,
+        amountSold,
+        seq,
+        expiresAt,
+        user,
+        flags,
+    ) in ORDER.iter_unpack(data[offset:end]):
+        isBuy = flags & BUY != 0
+        if stockId != runStock or price != runPrice or isBuy != runBuy:
+            if run:
+                books[runBuy][runStock].extend(runPrice, run)
+            run = []
+            runStock, runPrice, runBuy = stockId, price, isBuy
+        run.append(
+            RestingOrder(
+                stockTxId,
+                users[user],
+                stockId,
+                price,
+                quantity,
+                amountSold,
+                seq,
+                "LIMIT" if flags & LIMIT else "MARKET",
+                isBuy,
+                expiresAt or None,
+            )
+        )
+    if run:
+        books[runBuy][runStock].extend(runPrice, run)
+
+    for journalGeneration in journal.generations():
+        if journalGeneration >= generation:
+            replayJournal(
+                books,
+                index,
+                journal.path(journalGeneration),
+                journalGeneration,
+                committed,
+            )
+
+    return generation
+
+
+def replayJournal(books, index, path, generation=None, committed=None):
+    with open(path, "rb") as file:
+        data = file.read()
+
+    offset = 0
+    try:
+        while offset < len(data):
+            (op,) = JOURNAL_OP.unpack_from(data, offset)
+            offset += JOURNAL_OP.size
+
+            if op == BATCH:
+                number, length = JOURNAL_BATCH.unpack_from(data, offset)
+                offset += JOURNAL_BATCH.size
+                if offset + length > len(data):
+                    break
+                # a block's records are replayed like any others once it's known to count
+                if committed is not None and (generation, number) not in committed:
+                    offset += length
+
+            elif op == ADD or op == RESTORE:
+                fields = ORDER.unpack_from(data, offset)
+                offset += ORDER.size
+                userId = data[offset : offset + fields[7]]
+                offset += fields[7]
+                if len(userId) != fields[7]:
+                    break
+
+                order = unpackOrder(fields, sys.intern(userId.decode()))
+                if op == ADD:
+                    books[order.is_buy][order.stock_id].add(order)
+                else:
+                    books[order.is_buy][order.stock_id].restore(order)
+
+            elif op == FILL:
+                stockTxId, quantity = JOURNAL_FILL.unpack_from(data, offset)
+                offset += JOURNAL_FILL.size
+                order = index[stockTxId]
+                books[order.is_buy][order.stock_id].fill(order, quantity)
+
+            elif op == CANCEL:
+                (stockTxId,) = JOURNAL_CANCEL.unpack_from(data, offset)
+                offset += JOURNAL_CANCEL.size
+                order = index[stockTxId]
+                books[order.is_buy][order.stock_id].cancel(order)
+
+            else:
+                break
+    except struct.error:
+        # the engine stopped halfway through writing the last record
+        pass
@@ -0,0 +1,146 @@
+import contextvars
+from contextlib import contextmanager
+from schemas.common import SuccessResponse
+from schemas.engine import StockPrice, MAX_DEPTH_LEVELS
+from schemas.marketdata import PriceUpdate
+
+
+class BookChanges:
+    """Hands the stocks whose books changed to ``boards`` once the change has committed.
+
+    The books call ``changed`` whenever an order is added, filled, cancelled or restored.
+    Inside ``batch`` that only notes the stock, and ``commit`` passes the noted stocks to each
+    board's ``commit`` after the batch has committed, so the boards never show a batch still in
+    flight, or one that rolls back. A change outside a batch is passed on straight away.
+    """
+
+    def __init__(self, *boards):
+        self.boards = boards
+        self.pending = contextvars.ContextVar("book-changes", default=None)
+
+    @contextmanager
+    def batch(self):
+        stocks = set()
+        token = self.pending.set(stocks)
+        try:
+            yield stocks
+        finally:
+            self.pending.reset(token)
+
+    def changed(self, book, order):
+        stocks = self.pending.get()
+        if stocks is None:
+            self.commit((order.stock_id,))
+        else:
+            stocks.add(order.stock_id)
+
+    def commit(self, stocks):
+        for board in self.boards:
+            board.commit(stocks)
+
+
+class PriceBoard:
+    """The GET_PRICES reply for the ask books, kept serialized between changes.
+
+    ``commit`` takes the best price and volume of the stocks a committed batch changed (see
+    BookChanges) into ``tops``, and drops the cached reply if any of them moved. The reply is
+    only rebuilt by the first GET_PRICES after that, so polling an idle market never leaves
+    memory.
+
+    ``changes`` reports the stocks whose committed best price or volume moved since it was last
+    called, for the market data feed.
+
+    Stock names are looked up through ``lookupNames`` (stock_id -> name) the first time a stock
+    with volume has no name, e.g. a stock created after the engine started.
+    """
+
+    def __init__(self, books, lookupNames):
+        self.books = books
+        self.lookupNames = lookupNames
+        self.names = {}
+        # stock_id -> (best ask, volume) as last committed, for the stocks with sell volume
+        self.tops = {}
+        self.payload = None
+        self.moved = set()
+        self.published = {}
+
+    # Takes the best price and volume of <stocks> as they are now
+    def commit(self, stocks):
+        for stock_id in stocks:
+            book = self.books.get(stock_id)
+            top = (book.best_price(), book.quantity) if book else None
+            if self.tops.get(stock_id) == top:
+                continue
+
+            if top is None:
+                del self.tops[stock_id]
+            else:
+                self.tops[stock_id] = top
+            self.moved.add(stock_id)
+            self.payload = None
+
+    def changes(self):
+        updates = []
+        for stock_id in self.moved:
+            top = self.tops.get(stock_id, (None, 0))
+            if self.published.get(stock_id, (None, 0)) != top:
+                self.published[stock_id] = top
+                updates.append(
+                    PriceUpdate(
+                        stock_id=stock_id,
+                        current_price=top[0],
+                        quantity_available=top[1],
+                    )
+                )
+        self.moved.clear()
+        return updates
+
+    async def reply(self):
+        if self.payload is None:
+            if not self.tops.keys() <= self.names.keys():
+                self.names = await self.lookupNames()
+
+            prices = []
+            for stock_id, (price, quantity) in self.tops.items():
+                prices.append(
+                    StockPrice(
+                        stock_id=stock_id,
+                        stock_name=self.names.get(stock_id, ""),
+                        current_price=price,
+                        quantity_available=quantity,
+                    )
+                )
+            prices.sort(key=lambda price: price.stock_name, reverse=True)
+            self.payload = SuccessResponse(data=prices).model_dump_json().encode()
+        return self.payload
+
+
+class DepthBoard:
+    """The best MAX_DEPTH_LEVELS price levels on each side of every book, as last committed.
+
+    ``commit`` copies them from the books of the stocks a committed batch changed (see
+    BookChanges), so GET_DEPTH is answered from here straight away, without waiting for the
+    stock's batches or seeing one half done.
+    """
+
+    def __init__(self, bids, asks):
+        self.bids = bids
+        self.asks = asks
+        # stock_id -> ([(price, quantity, orders)] for the bids, the same for the asks)
+        self.levels = {}
+
+    def commit(self, stocks):
+        for stock_id in stocks:
+            sides = tuple(
+                book.depth(MAX_DEPTH_LEVELS) if book else []
+                for book in (self.bids.get(stock_id), self.asks.get(stock_id))
+            )
+            if any(sides):
+                self.levels[stock_id] = sides
+            else:
+                self.levels.pop(stock_id, None)
+
+    # The best <levels> levels of each side of <stock_id>'s book, best price first
+    def depth(self, stock_id: int, levels: int):
+        bids, asks = self.levels.get(stock_id, ([], []))
+        return bids[:levels], asks[:levels]
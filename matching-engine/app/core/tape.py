@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+# candles kept per stock and interval
+CANDLE_HISTORY = int(os.getenv("CANDLE_HISTORY") or 1440)
+
+# interval name -> seconds
+CANDLE_INTERVALS = {"1s": 1, "1m": 60, "5m": 300}
+
+
+class CandleSeries:
+    """OHLCV candles of one interval for one stock, newest last, in preallocated ring buffers.
+
+    Every trade updates the newest candle, or starts the next one once its time passes the end
+    of the newest, so the candles are always current without going back over the trades.
+    Intervals with no trades get no candle. A trade timestamped before the newest candle (the
+    clock going backwards) is counted in the newest one.
+    """
+
+    def __init__(self, interval: int, size: int):
+        self.interval = interval
+        self.size = size
+        self.start = np.zeros(size, np.int64)
+        self.open = np.zeros(size, np.int64)
+        self.high = np.zeros(size, np.int64)
+        self.low = np.zeros(size, np.int64)
+        self.close = np.zeros(size, np.int64)
+        self.volume = np.zeros(size, np.int64)
+        self.newest = -1
+        self.count = 0
+
+    def add(self, price: int, quantity: int, at: float):
+        start = int(at // self.interval) * self.interval
+        i = self.newest
+
+        if self.count and start <= self.start[i]:
+            if price > self.high[i]:
+                self.high[i] = price
+            if price < self.low[i]:
+                self.low[i] = price
+            self.close[i] = price
+            self.volume[i] += quantity
+            return
+
+        i = self.newest = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.start[i] = start
+        self.open[i] = self.high[i] = self.low[i] = self.close[i] = price
+        self.volume[i] = quantity
+
+    # Positions of the newest <limit> candles, oldest first
+    def positions(self, limit: int):
+        count = min(limit, self.count)
+        return (self.newest - np.arange(count - 1, -1, -1)) % self.size
+
+    def nbytes(self):
+        return sum(
+            column.nbytes
+            for column in (
+                self.start,
+                self.open,
+                self.high,
+                self.low,
+                self.close,
+                self.volume,
+            )
+        )
+
+
+class TradeTape:
+    """The 1s/1m/5m candles of the executed trades, per stock.
+
+    A stock's candles are allocated the first time it trades and never grow, so the tape costs
+    a fixed amount of memory per traded stock however many trades there are.
+    """
+
+    def __init__(self, candleSize: int = CANDLE_HISTORY):
+        self.candleSize = candleSize
+        # stock_id -> interval name -> CandleSeries
+        self.stocks = {}
+
+    def record(self, stock_id: int, price: int, quantity: int, at: float):
+        candles = self.stocks.get(stock_id)
+        if candles is None:
+            candles = self.stocks[stock_id] = {
+                name: CandleSeries(seconds, self.candleSize)
+                for name, seconds in CANDLE_INTERVALS.items()
+            }
+        for series in candles.values():
+            series.add(price, quantity, at)
+
+    # The newest <limit> candles of <interval> for <stock_id>, oldest first, as
+    # (start, open, high, low, close, volume) tuples of ints
+    def candles(self, stock_id: int, interval: str, limit: int):
+        candles = self.stocks.get(stock_id)
+        if candles is None:
+            return []
+
+        series = candles[interval]
+        at = series.positions(limit)
+        return list(
+            zip(
+                series.start[at].tolist(),
+                series.open[at].tolist(),
+                series.high[at].tolist(),
+                series.low[at].tolist(),
+                series.close[at].tolist(),
+                series.volume[at].tolist(),
+            )
+        )
+
+    def nbytes(self):
+        return sum(
+            series.nbytes()
+            for candles in self.stocks.values()
+            for series in candles.values()
+        )
@@ -0,0 +1,71 @@
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of (due tick, item) entries, one tick being one second.
+
+    Level 0 has a slot per tick for the next 64 ticks, level 1 a slot per 64 ticks for the next
+    4096, and so on; each level covers 64 times the span of the one below. Scheduling is O(1):
+    an entry goes into the slot of the lowest level whose span reaches its due tick. When a
+    level's slot comes round, its entries are moved down to the level below, so by the time
+    an entry is due it is in level 0 and ``advance`` hands it back. An entry is moved at most
+    once per level, whatever the number of entries.
+
+    Entries due further out than the top level reaches wait in its furthest slot and are
+    placed again when that comes round. Entries are never removed early: callers check what
+    they get back is still due (e.g. that the order hasn't been cancelled since).
+    """
+
+    def __init__(self, now: int, levels: int = 4):
+        self.now = now
+        self.levels = [[[] for _ in range(SLOTS)] for _ in range(levels)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, due: int, item):
+        self.count += 1
+        # already due: it fires on the next tick
+        self._place(max(due, self.now + 1), item)
+
+    # Puts an entry in the lowest level that reaches <due>. <due> may be the current tick while
+    # cascading, before level 0's slot for it has been read.
+    def _place(self, due: int, item):
+        delta = due - self.now
+        top = len(self.levels) - 1
+        for level, slots in enumerate(self.levels):
+            shift = SLOT_BITS * level
+            if delta < SLOTS << shift:
+                slots[(due >> shift) & MASK].append((due, item))
+                return
+            if level == top:
+                # beyond the wheel: park it in the top level's slot that comes round last
+                slots[((self.now >> shift) - 1) & MASK].append((due, item))
+
+    # Moves the wheel forward to <now> and returns the items that came due, oldest first
+    def advance(self, now: int):
+        due = []
+        while self.now < now:
+            self.now += 1
+            tick = self.now
+
+            # cascade the higher levels whose slot just came round, top down so entries land
+            # in the lower level before it is cascaded in turn
+            for level in range(len(self.levels) - 1, 0, -1):
+                shift = SLOT_BITS * level
+                if tick & ((1 << shift) - 1) == 0:
+                    slot = self.levels[level][(tick >> shift) & MASK]
+                    entries = slot[:]
+                    slot.clear()
+                    for entryDue, item in entries:
+                        self._place(entryDue, item)
+
+            slot = self.levels[0][tick & MASK]
+            if slot:
+                due.extend(item for _, item in slot)
+                self.count -= len(slot)
+                slot.clear()
+        return due
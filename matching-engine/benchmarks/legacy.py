@@ -0,0 +1,24 @@
+# The pydantic model the book used to store, kept to compare against
+
+from pydantic import BaseModel
+from typing import Literal, Optional
+
+
+class SellOrder(BaseModel):
+    user_id: str
+    stock_id: int
+    quantity: int
+    price: int
+    timestamp: str
+    order_type: Literal["MARKET", "LIMIT"]
+    stock_tx_id: Optional[int] = None
+    is_child: bool
+    amount_sold: int
+
+    def __eq__(self, other):
+        return self.price == other.price
+
+    def __lt__(self, other):
+        if self.price == other.price:
+            return self.timestamp < other.timestamp
+        return self.price < other.price
@@ -0,0 +1,144 @@
+# Buy latency against books of increasing size.
+#
+# Run from the repo root:
+#   python3 -m matching-engine.benchmarks.orderbook_benchmark
+#   python3 -m matching-engine.benchmarks.orderbook_benchmark --sizes 1000 10000 --buys 500
+#
+# Every buy is followed by re-adding the volume it consumed so the book stays the same size
+# for the whole run. Only the matching step is timed, settlement is not involved.
+
+import argparse
+import copy
+import random
+import time
+from heapq import heappop, heappush
+from statistics import mean, quantiles
+
+from ..app.core.orderbook import OrderBook, RestingOrder
+from .legacy import SellOrder
+
+PRICE_LEVELS = 1000
+ORDER_QUANTITY = 10
+BUY_QUANTITY = 25
+
+
+class OrderFactory:
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def make(self):
+        self.count += 1
+        return RestingOrder(
+            stock_tx_id=self.count,
+            user_id=f"seller-{self.count % 500}",
+            stock_id=1,
+            price=self.random.randrange(100, 100 + PRICE_LEVELS),
+            quantity=ORDER_QUANTITY,
+            amount_sold=0,
+            seq=self.count,
+            order_type="LIMIT",
+        )
+
+    def makeLegacy(self):
+        self.count += 1
+        return SellOrder.model_construct(
+            user_id=f"seller-{self.count % 500}",
+            stock_id=1,
+            quantity=ORDER_QUANTITY,
+            price=self.random.randrange(100, 100 + PRICE_LEVELS),
+            timestamp=f"{self.count:012d}",
+            order_type="LIMIT",
+            stock_tx_id=self.count,
+            is_child=False,
+            amount_sold=0,
+        )
+
+
+def benchBook(size, buys, seed):
+    factory = OrderFactory(seed)
+    book = OrderBook()
+    for _ in range(size):
+        book.add(factory.make())
+
+    timings = []
+    for _ in range(buys):
+        start = time.perf_counter()
+        fills = book.match("buyer", BUY_QUANTITY)
+        timings.append(time.perf_counter() - start)
+
+        for _ in range(
+            sum(1 for order, _ in fills if order.amount_sold == order.quantity)
+        ):
+            book.add(factory.make())
+
+    return timings
+
+
+# The previous matcher: deep copy the whole heap, then pop until the buy is filled
+def benchDeepcopyHeap(size, buys, seed):
+    factory = OrderFactory(seed)
+    tree = []
+    for _ in range(size):
+        heappush(tree, factory.makeLegacy())
+
+    timings = []
+    for _ in range(buys):
+        start = time.perf_counter()
+        tempTree = copy.deepcopy(tree)
+        needed = BUY_QUANTITY
+        consumed = 0
+        while needed:
+            order = heappop(tempTree)
+            taken = min(order.quantity - order.amount_sold, needed)
+            order.amount_sold += taken
+            needed -= taken
+            if order.amount_sold < order.quantity:
+                heappush(tempTree, order)
+            else:
+                consumed += 1
+        tree = tempTree
+        timings.append(time.perf_counter() - start)
+
+        for _ in range(consumed):
+            heappush(tree, factory.makeLegacy())
+
+    return timings
+
+
+def report(name, size, timings):
+    cuts = quantiles(timings, n=100)
+    print(
+        f"{name:<14} {size:>10,} orders  "
+        f"mean={mean(timings) * 1e6:>10.1f}us  "
+        f"p50={cuts[49] * 1e6:>10.1f}us  "
+        f"p99={cuts[98] * 1e6:>10.1f}us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--buys", type=int, default=2000)
+    parser.add_argument(
+        "--deepcopy-limit",
+        type=int,
+        default=10_000,
+        help="largest book to run the old deep copy matcher against",
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        report("price levels", size, benchBook(size, args.buys, args.seed))
+
+    for size in args.sizes:
+        if size <= args.deepcopy_limit:
+            buys = min(args.buys, 100)
+            report("deepcopy heap", size, benchDeepcopyHeap(size, buys, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Memory per resting order and book throughput for the old pydantic SellOrder against the
+# slotted RestingOrder the book stores now.
+#
+# Run from the repo root:
+#   python3 -m matching-engine.benchmarks.record_benchmark
+#   python3 -m matching-engine.benchmarks.record_benchmark --orders 100000
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+
+from ..app.core.orderbook import OrderBook, RestingOrder
+from .legacy import SellOrder
+
+USERS = 1000
+START = datetime(2025, 1, 1, 9, 30)
+
+
+# Both factories build orders the way the engine does when a STOCK_ORDER arrives: the legacy one
+# gets a fresh user id string per message and a str(datetime) timestamp, the new one interns
+# the user id and takes the next sequence number.
+def legacyOrders(count, seed):
+    rng = random.Random(seed)
+    users = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(USERS)]
+    return [
+        SellOrder(
+            user_id="".join(users[rng.randrange(USERS)]),
+            stock_id=1,
+            quantity=rng.randrange(1, 100),
+            price=rng.randrange(100, 1100),
+            timestamp=str(START + timedelta(microseconds=i)),
+            order_type="LIMIT",
+            stock_tx_id=i,
+            is_child=False,
+            amount_sold=0,
+        )
+        for i in range(count)
+    ]
+
+
+def slottedOrders(count, seed):
+    rng = random.Random(seed)
+    users = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(USERS)]
+    return [
+        RestingOrder(
+            stock_tx_id=i,
+            user_id=sys.intern("".join(users[rng.randrange(USERS)])),
+            stock_id=1,
+            price=rng.randrange(100, 1100),
+            quantity=rng.randrange(1, 100),
+            amount_sold=0,
+            seq=i,
+            order_type="LIMIT",
+        )
+        for i in range(count)
+    ]
+
+
+def bytesPerOrder(build, count, seed):
+    gc.collect()
+    tracemalloc.start()
+    orders = build(count, seed)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del orders
+    return size / count
+
+
+def heapOpsPerSecond(orders):
+    heap = []
+    start = time.perf_counter()
+    for order in orders:
+        heappush(heap, order)
+    while heap:
+        heappop(heap)
+    return 2 * len(orders) / (time.perf_counter() - start)
+
+
+def bookOpsPerSecond(orders):
+    book = OrderBook()
+    start = time.perf_counter()
+    for order in orders:
+        book.add(order)
+    ops = len(orders)
+    while book.quantity >= 50:
+        book.match("buyer", 50)
+        ops += 1
+    return ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(f"{'':<24}{'pydantic SellOrder':>20}{'RestingOrder':>16}")
+    print(
+        f"{'bytes per order':<24}"
+        f"{bytesPerOrder(legacyOrders, args.orders, args.seed):>20.0f}"
+        f"{bytesPerOrder(slottedOrders, args.orders, args.seed):>16.0f}"
+    )
+
+    legacy = legacyOrders(args.orders, args.seed)
+    slotted = slottedOrders(args.orders, args.seed)
+    slottedKeys = [(order.price, order.seq, order) for order in slotted]
+    print(
+        f"{'heap push+pop ops/s':<24}"
+        f"{heapOpsPerSecond(legacy):>20,.0f}"
+        f"{heapOpsPerSecond(slottedKeys):>16,.0f}"
+    )
+
+    legacy = legacyOrders(args.orders, args.seed)
+    slotted = slottedOrders(args.orders, args.seed)
+    print(
+        f"{'book add+match ops/s':<24}"
+        f"{bookOpsPerSecond(legacy):>20,.0f}"
+        f"{bookOpsPerSecond(slotted):>16,.0f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# Replays an order stream through the engine with the database and Redis stubbed out.
+#
+# Run from the repo root:
+#   python3 -m matching-engine.benchmarks.replay_benchmark
+#   python3 -m matching-engine.benchmarks.replay_benchmark --stocks 10 --book-size 10000 \
+#       --orders 500000 --mix 50 30 20 --seed 7
+#   python3 -m matching-engine.benchmarks.replay_benchmark --record stream.jsonl
+#   python3 -m matching-engine.benchmarks.replay_benchmark --replay stream.jsonl
+#
+# The books are first loaded with <book-size> resting orders per stock (half asks, half bids),
+# then <orders> messages are sent, mixed between buys, sells and cancels by the --mix weights.
+# Messages go through processBatch in batches of --batch-size, like the engine's intake, and
+# every receiveOrder/cancelOrderEngine call is timed on its own. The same seed always produces
+# the same stream, so runs can be compared over time; --record saves it and --replay reads it
+# back, which also allows replaying streams captured elsewhere in the same format:
+#
+#   {"preload": <messages at the start that aren't measured>}          first line
+#   {"user_id": ..., "order": {<StockOrder>}}
+#   {"user_id": ..., "cancel": {<CancelOrder>}}
+
+import argparse
+import asyncio
+import json
+import random
+import resource
+import time
+from statistics import quantiles
+
+from schemas.engine import CancelOrder, StockOrder
+
+from .stubs import engine, install
+
+
+def synthesize(args):
+    rng = random.Random(args.seed)
+    users = [f"user-{i}" for i in range(args.users)]
+    messages = []
+    # (stock_tx_id, user_id) of every order that gets an id, in the order the stub hands them out
+    placed = []
+
+    def order(user, **fields):
+        messages.append({"user_id": user, "order": fields})
+        if not fields["is_buy"] or fields["order_type"] == "LIMIT":
+            placed.append((len(placed) + 1, user))
+
+    def sell(user, stock):
+        order(
+            user,
+            stock_id=stock,
+            is_buy=False,
+            order_type="LIMIT",
+            quantity=rng.randrange(1, 50),
+            price=rng.randrange(95, 120),
+        )
+
+    def buy(user, stock, limit):
+        if limit:
+            order(
+                user,
+                stock_id=stock,
+                is_buy=True,
+                order_type="LIMIT",
+                quantity=rng.randrange(1, 20),
+                price=rng.randrange(80, 105),
+            )
+        else:
+            order(
+                user,
+                stock_id=stock,
+                is_buy=True,
+                order_type="MARKET",
+                quantity=rng.randrange(1, 20),
+            )
+
+    for stock in range(args.stocks):
+        for i in range(args.book_size):
+            if i % 2:
+                buy(rng.choice(users), stock, limit=True)
+            else:
+                sell(rng.choice(users), stock)
+    preload = len(messages)
+
+    buyWeight, sellWeight, cancelWeight = args.mix
+    for _ in range(args.orders):
+        pick = rng.uniform(0, buyWeight + sellWeight + cancelWeight)
+        user = rng.choice(users)
+        stock = rng.randrange(args.stocks)
+        if pick < buyWeight:
+            buy(user, stock, limit=rng.random() < args.limit_buys)
+        elif pick < buyWeight + sellWeight:
+            sell(user, stock)
+        else:
+            stockTxId, owner = rng.choice(placed)
+            messages.append({"user_id": owner, "cancel": {"stock_tx_id": stockTxId}})
+
+    return preload, messages
+
+
+def record(path, preload, messages):
+    with open(path, "w") as file:
+        file.write(json.dumps({"preload": preload}) + "\n")
+        for message in messages:
+            file.write(json.dumps(message) + "\n")
+
+
+def load(path):
+    with open(path) as file:
+        preload = json.loads(file.readline())["preload"]
+        return preload, [json.loads(line) for line in file]
+
+
+# Parses every message up front so only the engine is timed
+def jobs(messages, latencies):
+    def timed(call, request, user_id):
+        async def job(batch):
+            start = time.perf_counter()
+            try:
+                return await call(request, user_id, batch)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        return job
+
+    parsed = []
+    for message in messages:
+        if "order" in message:
+            request = StockOrder.model_validate(message["order"])
+            parsed.append(timed(engine.receiveOrder, request, message["user_id"]))
+        else:
+            request = CancelOrder.model_validate(message["cancel"])
+            parsed.append(timed(engine.cancelOrderEngine, request, message["user_id"]))
+    return parsed
+
+
+# The number of orders the engine turned away. A batch that fails as a whole (its orders get
+# a 500) means the stubs no longer cover something the engine does, and would leave only
+# rolled back batches to time, so that stops the run.
+async def run(batches):
+    rejected = 0
+    for batch in batches:
+        for status, response in await engine.processBatch(batch):
+            if status == "ERROR" and response.status_code == 500:
+                raise SystemExit(
+                    "a batch failed in the engine (see above); update benchmarks/stubs.py"
+                )
+            rejected += status == "ERROR"
+    return rejected
+
+
+def chunks(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stocks", type=int, default=100)
+    parser.add_argument(
+        "--book-size", type=int, default=1000, help="resting orders per stock"
+    )
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument(
+        "--mix",
+        type=float,
+        nargs=3,
+        default=[40, 40, 20],
+        metavar=("BUY", "SELL", "CANCEL"),
+        help="relative weights of buys, sells and cancels",
+    )
+    parser.add_argument(
+        "--limit-buys",
+        type=float,
+        default=0.5,
+        help="share of buys that are limit orders",
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--record", help="write the stream to this file")
+    parser.add_argument("--replay", help="replay the stream in this file instead")
+    args = parser.parse_args()
+
+    if args.replay:
+        preload, messages = load(args.replay)
+    else:
+        preload, messages = synthesize(args)
+    if args.record:
+        record(args.record, preload, messages)
+
+    install(args.stocks)
+
+    latencies = []
+    asyncio.run(run(chunks(jobs(messages[:preload], []), args.batch_size)))
+
+    measured = jobs(messages[preload:], latencies)
+    began = time.perf_counter()
+    rejected = asyncio.run(run(chunks(measured, args.batch_size)))
+    seconds = time.perf_counter() - began
+
+    cuts = quantiles(latencies, n=1000)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"messages         {len(measured):,} after {preload:,} preloaded, seed {args.seed}"
+    )
+    print(
+        f"throughput       {len(measured) / seconds:,.0f} orders/s  ({rejected:,} rejected)"
+    )
+    print(
+        f"latency          p50={cuts[499] * 1e6:.1f}us  p99={cuts[989] * 1e6:.1f}us  "
+        f"p999={cuts[998] * 1e6:.1f}us"
+    )
+    print(f"resting orders   {len(engine.orderIndex):,}")
+    print(f"peak rss         {peak:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
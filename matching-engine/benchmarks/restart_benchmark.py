@@ -0,0 +1,106 @@
+# Time to restore the books after a restart from a snapshot plus journal.
+#
+# Run from the repo root:
+#   python3 -m matching-engine.benchmarks.restart_benchmark
+#   python3 -m matching-engine.benchmarks.restart_benchmark --orders 1000000 --journal 200000
+#
+# Builds <orders> resting orders across <stocks> books, snapshots them, then applies <journal>
+# more changes (a mix of new orders, fills and cancels) that only go to the journal. The
+# restore loads the snapshot and replays the journal into empty books, like engine startup.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+from ..app.core.orderbook import OrderBook, RestingOrder
+from ..app.core.persistence import Journal, loadBooks, writeSnapshot
+
+PARTITION = 0
+PARTITIONS = 1
+
+
+def makeOrder(rng, stockTxId, stocks, users):
+    return RestingOrder(
+        stock_tx_id=stockTxId,
+        user_id=users[rng.randrange(len(users))],
+        stock_id=rng.randrange(stocks),
+        price=rng.randrange(100, 1100),
+        quantity=rng.randrange(1, 100),
+        amount_sold=0,
+        seq=stockTxId,
+        order_type="LIMIT",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=5_000_000)
+    parser.add_argument("--stocks", type=int, default=100)
+    parser.add_argument("--journal", type=int, default=500_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    users = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(10_000)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = Journal(directory, PARTITION)
+        index = {}
+        asks = defaultdict(lambda: OrderBook(index, journal))
+
+        for stockTxId in range(args.orders):
+            order = makeOrder(rng, stockTxId, args.stocks, users)
+            asks[order.stock_id].add(order)
+
+        journal.open()
+        began = time.perf_counter()
+        writeSnapshot((asks, {}), directory, PARTITION, PARTITIONS, journal.generation)
+        snapshotSeconds = time.perf_counter() - began
+        snapshotBytes = os.path.getsize(
+            os.path.join(directory, f"snapshot-{PARTITION}.bin")
+        )
+
+        nextId = args.orders
+        for _ in range(args.journal):
+            choice = rng.random()
+            if choice < 0.5:
+                order = makeOrder(rng, nextId, args.stocks, users)
+                nextId += 1
+                asks[order.stock_id].add(order)
+            else:
+                order = index.get(rng.randrange(nextId))
+                if order is None:
+                    continue
+                if choice < 0.8:
+                    asks[order.stock_id].fill(order, 1)
+                else:
+                    asks[order.stock_id].cancel(order)
+        journal.flush()
+        journalBytes = os.path.getsize(journal.path(journal.generation))
+        expected = len(index)
+
+        del asks, index
+        restoredIndex = {}
+        restoredBooks = (
+            defaultdict(lambda: OrderBook(restoredIndex)),
+            defaultdict(lambda: OrderBook(restoredIndex, is_buy=True)),
+        )
+        began = time.perf_counter()
+        loadBooks(
+            restoredBooks, restoredIndex, Journal(directory, PARTITION), PARTITIONS
+        )
+        restoreSeconds = time.perf_counter() - began
+
+    assert len(restoredIndex) == expected
+    print(f"resting orders   {expected:,}")
+    print(f"snapshot write   {snapshotSeconds:.2f}s  {snapshotBytes / 2**20:.1f} MiB")
+    print(f"journal          {args.journal:,} changes  {journalBytes / 2**20:.1f} MiB")
+    print(f"restore          {restoreSeconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
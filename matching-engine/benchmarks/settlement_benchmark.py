@@ -0,0 +1,176 @@
+# Database round trips and time to settle market buys, one leg at a time (settleLeg, each leg
+# in its own savepoint, as the workers used to) against all of a batch's legs together
+# (settleLegs).
+#
+# Needs a database with the schema in it, e.g. the stack's. Run from the repo root:
+#   python3 -m matching-engine.benchmarks.settlement_benchmark \
+#       --url postgresql+asyncpg://admin:<password>@localhost:5433/day_trader
+#   python3 -m matching-engine.benchmarks.settlement_benchmark --buys 20 --fills 5
+#
+# Every run makes its own users, stock and sell orders and rolls everything back at the end.
+# Each buy of <fills> fills is one market buy leg and a sell leg per fill; every other sell is
+# filled completely, the rest partially. A round trip is a statement sent to the server.
+
+import argparse
+import asyncio
+import os
+import time
+import uuid
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from schemas.settlement import SettlementLeg
+from ..app.core.engineDbConnect import settleLeg, settleLegs, stockFromSeller, url
+from ..app.core.orderbook import RestingOrder
+
+PRICE = 10
+
+
+class RoundTrips:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self.executed)
+
+    def executed(self, *args):
+        self.count += 1
+
+
+async def makeAccounts(connection, users, stock_id):
+    await connection.execute(
+        text(
+            "INSERT INTO stocks (stock_id, stock_name, current_price) VALUES (:s, :n, 0)"
+        ),
+        {"s": stock_id, "n": f"benchmark-{stock_id}"},
+    )
+    for user_id in users:
+        await connection.execute(
+            text(
+                "INSERT INTO users (id, user_name, name, password, salt) "
+                "VALUES (:u, :u, 'benchmark', '', '')"
+            ),
+            {"u": user_id},
+        )
+        await connection.execute(
+            text("INSERT INTO wallets (user_id, balance) VALUES (:u, 0)"),
+            {"u": user_id},
+        )
+        await connection.execute(
+            text(
+                "INSERT INTO stockportfolios (user_id, stock_id, quantity_owned) "
+                "VALUES (:u, :s, 1000000)"
+            ),
+            {"u": user_id, "s": stock_id},
+        )
+
+
+# The legs of <buys> market buys by <buyer>, each filling <fills> fresh sell orders
+async def makeLegs(session, buyer, sellers, stock_id, buys, fills):
+    legs = []
+    for _ in range(buys):
+        for fill in range(fills):
+            seller = sellers[fill % len(sellers)]
+            sell = RestingOrder(
+                stock_tx_id=None,
+                user_id=seller,
+                stock_id=stock_id,
+                price=PRICE,
+                quantity=10,
+                amount_sold=0,
+                seq=0,
+                order_type="LIMIT",
+            )
+            sell.stock_tx_id = await stockFromSeller(session, sell)
+            quantity = 10 if fill % 2 == 0 else 4
+            legs.append(
+                SettlementLeg(
+                    user_id=seller,
+                    stock_id=stock_id,
+                    stock_tx_id=sell.stock_tx_id,
+                    is_buy=False,
+                    order_type="LIMIT",
+                    quantity=quantity,
+                    price=PRICE,
+                    amount=PRICE * quantity,
+                    completes=quantity == 10,
+                    matched_at=time.time(),
+                )
+            )
+        bought = sum(leg.quantity for leg in legs[-fills:])
+        legs.append(
+            SettlementLeg(
+                user_id=buyer,
+                stock_id=stock_id,
+                is_buy=True,
+                order_type="MARKET",
+                quantity=bought,
+                price=PRICE,
+                amount=PRICE * bought,
+                matched_at=time.time(),
+            )
+        )
+    return legs
+
+
+async def oneAtATime(session, legs):
+    for leg in legs:
+        async with session.begin_nested():
+            await settleLeg(session, leg)
+
+
+async def together(session, legs):
+    async with session.begin_nested():
+        await settleLegs(session, legs)
+
+
+async def run(args):
+    engine = create_async_engine(args.url)
+    trips = RoundTrips(engine)
+    stock_id = int(time.time()) % 1_000_000 + 1_000_000
+    buyer = f"benchmark-buyer-{uuid.uuid4()}"
+    sellers = [f"benchmark-seller-{uuid.uuid4()}" for _ in range(args.fills)]
+
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        session = AsyncSession(bind=connection, expire_on_commit=False)
+        await makeAccounts(connection, [buyer, *sellers], stock_id)
+        fillCount = args.buys * args.fills
+
+        for name, settle in (
+            ("one leg at a time", oneAtATime),
+            ("set-based", together),
+        ):
+            legs = await makeLegs(
+                session, buyer, sellers, stock_id, args.buys, args.fills
+            )
+            await session.flush()
+
+            before = trips.count
+            began = time.perf_counter()
+            await settle(session, legs)
+            await session.flush()
+            elapsed = time.perf_counter() - began
+            sent = trips.count - before
+
+            print(
+                f"{name:18} {len(legs)} legs ({args.buys} buys x {args.fills} fills): "
+                f"{sent} round trips, {sent / fillCount:.1f} per fill, "
+                f"{elapsed * 1000:.1f}ms"
+            )
+
+        await session.close()
+        await transaction.rollback()
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=os.getenv("BENCHMARK_DATABASE_URL") or url)
+    parser.add_argument("--buys", type=int, default=1)
+    parser.add_argument("--fills", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
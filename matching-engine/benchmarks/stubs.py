@@ -0,0 +1,77 @@
+# In-memory stand-ins for the database and Redis, so the engine can be measured by itself.
+#
+# install() swaps them into the engine module in place of what it imported from
+# engineDbConnect, and into engineDbConnect in place of its RedisClient. Ids are handed out in
+# call order, so a replay that places the same orders gets the same ids every time.
+
+import importlib
+from contextlib import asynccontextmanager
+
+from ..app.core import engineDbConnect
+
+# app.core re-exports the database engine as "engine", so the module is imported by name
+engine = importlib.import_module("..app.core.engine", __package__)
+
+
+class StubSession:
+    def begin_nested(self):
+        return stubSavepoint()
+
+    async def commit(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+@asynccontextmanager
+async def stubSavepoint():
+    yield
+
+
+class StubRedis:
+    def __init__(self, stocks):
+        self.stocks = {str(stock_id): f"STOCK{stock_id}" for stock_id in range(stocks)}
+
+    def get(self, key):
+        return self.stocks
+
+
+class StubDb:
+    def __init__(self):
+        self.nextId = 0
+
+    async def newTransaction(self, session, order):
+        self.nextId += 1
+        return self.nextId
+
+    async def settle(self, session, *args):
+        pass
+
+    # nothing is published, so nothing has to be kept for it
+    async def writeOutbox(self, session, partition, byQueue):
+        return []
+
+    # every account has plenty of both, so the ledger only turns away what the book would
+    async def balance(self, session, *args):
+        return 10**15
+
+
+def install(stocks: int):
+    db = StubDb()
+    engine.async_session_maker = StubSession
+    engine.stockFromSeller = db.newTransaction
+    engine.fundsFromBuyer = db.newTransaction
+    engine.reserveMarketBuy = db.settle
+    engine.cancelTransaction = db.settle
+    engine.setCurrentPrices = db.settle
+    engine.writeSettlementOutbox = db.writeOutbox
+    engine.recordJournalCommit = db.settle
+    engine.ledger.loadCash = db.balance
+    engine.ledger.loadShares = db.balance
+    engine.ownsStock = lambda stock_id: True
+    engineDbConnect.cache = StubRedis(stocks)
+    return db
@@ -0,0 +1,181 @@
+import importlib
+import random
+
+import pytest
+
+orderbook = importlib.import_module("matching-engine.app.core.orderbook")
+OrderBook = orderbook.OrderBook
+RestingOrder = orderbook.RestingOrder
+
+USERS = ["a", "b", "c", "d"]
+
+
+def makeOrder(stockTxId, user_id, price, quantity, is_buy=False):
+    return RestingOrder(
+        stock_tx_id=stockTxId,
+        user_id=user_id,
+        stock_id=1,
+        price=price,
+        quantity=quantity,
+        amount_sold=0,
+        seq=stockTxId,
+        order_type="LIMIT",
+        is_buy=is_buy,
+    )
+
+
+# What match() should return, worked out from the live orders alone: best price first, oldest
+# first within a price, skipping <user_id>'s own orders and stopping at <limit>
+def expectedFills(orders, is_buy, user_id, quantity, limit):
+    sign = 1 if is_buy else -1
+    live = sorted(orders.values(), key=lambda o: (-sign * o.price, o.seq))
+    fills = []
+    for order in live:
+        if quantity == 0:
+            break
+        if limit is not None and sign * order.price < sign * limit:
+            break
+        if order.user_id == user_id:
+            continue
+        taken = min(order.quantity - order.amount_sold, quantity)
+        fills.append((order.stock_tx_id, taken))
+        quantity -= taken
+    return fills
+
+
+def checkCounters(book, orders, is_buy):
+    remaining = {id: o.quantity - o.amount_sold for id, o in orders.items()}
+    assert len(book) == len(orders)
+    assert book.quantity == sum(remaining.values())
+    assert {o.stock_tx_id for o in book} == set(orders)
+
+    owned = {}
+    levels = {}
+    for id, order in orders.items():
+        owned[order.user_id] = owned.get(order.user_id, 0) + remaining[id]
+        quantity, count = levels.get(order.price, (0, 0))
+        levels[order.price] = (quantity + remaining[id], count + 1)
+    assert book.owned == owned
+
+    prices = sorted(levels, reverse=is_buy)
+    assert book.depth(len(prices) + 1) == [(p, *levels[p]) for p in prices]
+    assert book.best_price() == (prices[0] if prices else None)
+
+
+def test_market_buy_takes_best_price_then_oldest():
+    book = OrderBook()
+    book.add(makeOrder(1, "a", 11, 5))
+    book.add(makeOrder(2, "b", 10, 3))
+    book.add(makeOrder(3, "c", 10, 4))
+
+    fills = book.match("d", 9)
+
+    assert [(o.stock_tx_id, q) for o, q in fills] == [(2, 3), (3, 4), (1, 2)]
+    assert book.quantity == 3
+    assert book.best_price() == 11
+
+
+def test_match_steps_over_own_orders():
+    book = OrderBook()
+    book.add(makeOrder(1, "a", 10, 5))
+    book.add(makeOrder(2, "b", 10, 5))
+
+    fills = book.match("a", 5)
+
+    assert [(o.stock_tx_id, q) for o, q in fills] == [(2, 5)]
+    assert book.owned == {"a": 5}
+
+
+def test_unfillable_market_buy_leaves_book_untouched():
+    book = OrderBook()
+    book.add(makeOrder(1, "a", 10, 5))
+    book.add(makeOrder(2, "b", 10, 2))
+
+    with pytest.raises(ValueError) as error:
+        book.match("c", 8)
+    assert error.value.args == (400, "not enough sell volume to fill buy order")
+
+    with pytest.raises(ValueError) as error:
+        book.match("a", 3)
+    assert error.value.args[0] == 400
+
+    assert book.quantity == 7 and len(book) == 2
+
+
+def test_limit_match_on_bids_stops_below_limit():
+    book = OrderBook(is_buy=True)
+    book.add(makeOrder(1, "a", 9, 5, is_buy=True))
+    book.add(makeOrder(2, "b", 12, 5, is_buy=True))
+
+    fills = book.match("c", 8, limit=10)
+
+    assert [(o.stock_tx_id, q) for o, q in fills] == [(2, 5)]
+    assert book.best_price() == 9
+
+
+def test_rollback_puts_fills_back_in_place():
+    book = OrderBook()
+    for id, user in enumerate(["a", "b", "c"], 1):
+        book.add(makeOrder(id, user, 10, 2))
+
+    fills = book.match("d", 5)
+    book.rollback(fills)
+
+    assert [o.stock_tx_id for o in book] == [1, 2, 3]
+    assert all(o.amount_sold == 0 for o in book)
+    assert book.quantity == 6
+
+
+@pytest.mark.parametrize("is_buy", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_random_operations_match_a_simple_model(is_buy, seed):
+    rng = random.Random(seed)
+    book = OrderBook(is_buy=is_buy)
+    # stock_tx_id -> order, every live order; the model the book is checked against
+    orders = {}
+    cancelled = []
+    nextId = 1
+
+    for _ in range(400):
+        choice = rng.random()
+        if choice < 0.4:
+            order = makeOrder(
+                nextId, rng.choice(USERS), rng.randint(1, 8), rng.randint(1, 6), is_buy
+            )
+            nextId += 1
+            book.add(order)
+            orders[order.stock_tx_id] = order
+
+        elif choice < 0.55 and orders:
+            order = orders.pop(rng.choice(sorted(orders)))
+            book.cancel(order)
+            cancelled.append(order)
+
+        elif choice < 0.6 and cancelled:
+            order = cancelled.pop(rng.randrange(len(cancelled)))
+            book.restore(order)
+            orders[order.stock_tx_id] = order
+
+        else:
+            user_id = rng.choice(USERS)
+            quantity = rng.randint(1, 15)
+            limit = None if rng.random() < 0.5 else rng.randint(1, 8)
+            expected = expectedFills(orders, is_buy, user_id, quantity, limit)
+
+            if limit is None and sum(q for _, q in expected) < quantity:
+                with pytest.raises(ValueError):
+                    book.match(user_id, quantity)
+                checkCounters(book, orders, is_buy)
+                continue
+
+            fills = book.match(user_id, quantity, limit)
+            assert [(o.stock_tx_id, q) for o, q in fills] == expected
+
+            if rng.random() < 0.3:
+                book.rollback(fills)
+            else:
+                for order, _ in fills:
+                    if order.amount_sold == order.quantity:
+                        del orders[order.stock_tx_id]
+
+        checkCounters(book, orders, is_buy)
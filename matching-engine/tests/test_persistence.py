@@ -0,0 +1,231 @@
+import importlib
+import os
+import random
+from collections import defaultdict
+
+import pytest
+
+orderbook = importlib.import_module("matching-engine.app.core.orderbook")
+persistence = importlib.import_module("matching-engine.app.core.persistence")
+OrderBook = orderbook.OrderBook
+RestingOrder = orderbook.RestingOrder
+Journal = persistence.Journal
+
+PARTITION = 0
+PARTITIONS = 1
+
+
+def emptyBooks(index, journal=None):
+    return (
+        defaultdict(lambda: OrderBook(index, journal)),
+        defaultdict(lambda: OrderBook(index, journal, is_buy=True)),
+    )
+
+
+# Everything a restore has to get back, book by book: the live orders in queue order and the
+# counters kept alongside them
+def state(books):
+    return {
+        (is_buy, stock_id): (
+            [
+                (
+                    o.stock_tx_id,
+                    o.user_id,
+                    o.price,
+                    o.quantity,
+                    o.amount_sold,
+                    o.seq,
+                    o.order_type,
+                    o.expires_at,
+                )
+                for o in book
+            ],
+            book.quantity,
+            dict(book.owned),
+            book.depth(1000),
+        )
+        for is_buy, side in enumerate(books)
+        for stock_id, book in side.items()
+        if book
+    }
+
+
+def restore(directory, committed=None):
+    index = {}
+    books = emptyBooks(index)
+    generation = persistence.loadBooks(
+        books, index, Journal(directory, PARTITION), PARTITIONS, committed
+    )
+    return generation, books, index
+
+
+class RandomBooks:
+    """Books with a journal, changed at random the ways the engine changes them."""
+
+    def __init__(self, directory, seed):
+        self.rng = random.Random(seed)
+        self.journal = Journal(directory, PARTITION)
+        self.journal.open()
+        self.index = {}
+        self.books = emptyBooks(self.index, self.journal)
+        self.cancelled = []
+        self.nextId = 1
+        self.committed = set()
+
+    # Makes <steps> changes as one batch and writes its block, recording it as committed
+    def batch(self, steps):
+        with self.journal.batch() as records:
+            for _ in range(steps):
+                self.step()
+            self.committed.add(self.journal.commit(records))
+
+    def step(self):
+        rng = self.rng
+        choice = rng.random()
+        live = sorted(self.index)
+        if choice < 0.45 or not live:
+            is_buy = rng.random() < 0.5
+            order = RestingOrder(
+                stock_tx_id=self.nextId,
+                user_id=rng.choice(["a", "b", "c"]),
+                stock_id=rng.randint(1, 3),
+                price=rng.randint(1, 6),
+                quantity=rng.randint(1, 9),
+                amount_sold=0,
+                seq=self.nextId,
+                order_type="LIMIT" if is_buy or rng.random() < 0.5 else "MARKET",
+                is_buy=is_buy,
+                expires_at=rng.choice([None, 1_900_000_000 + self.nextId]),
+            )
+            self.nextId += 1
+            self.books[is_buy][order.stock_id].add(order)
+        elif choice < 0.6:
+            order = self.index[rng.choice(live)]
+            self.books[order.is_buy][order.stock_id].cancel(order)
+            self.cancelled.append(order)
+        elif choice < 0.65 and self.cancelled:
+            order = self.cancelled.pop()
+            if order.stock_tx_id not in self.index:
+                self.books[order.is_buy][order.stock_id].restore(order)
+        else:
+            is_buy = rng.random() < 0.5
+            book = self.books[is_buy][rng.randint(1, 3)]
+            fills = book.match(
+                rng.choice(["a", "b", "c"]), rng.randint(1, 12), limit=100 * is_buy
+            )
+            if rng.random() < 0.3:
+                book.rollback(fills)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_snapshot_plus_journal_restores_the_books(tmp_path, seed):
+    books = RandomBooks(str(tmp_path), seed)
+    for _ in range(30):
+        books.batch(10)
+
+    books.journal.rotate()
+    persistence.writeSnapshot(
+        books.books, str(tmp_path), PARTITION, PARTITIONS, books.journal.generation
+    )
+    for _ in range(30):
+        books.batch(books.rng.randint(1, 20))
+
+    generation, restored, index = restore(str(tmp_path), books.committed)
+
+    assert generation == books.journal.generation
+    assert state(restored) == state(books.books)
+    assert set(index) == set(books.index)
+
+
+def test_journal_alone_restores_over_an_empty_snapshot(tmp_path):
+    books = RandomBooks(str(tmp_path), 99)
+    persistence.writeSnapshot(
+        books.books, str(tmp_path), PARTITION, PARTITIONS, books.journal.generation
+    )
+    for _ in range(500):
+        books.step()
+    books.journal.flush()
+
+    _, restored, _ = restore(str(tmp_path))
+
+    assert state(restored) == state(books.books)
+
+
+def test_batch_is_written_only_when_committed(tmp_path):
+    books = RandomBooks(str(tmp_path), 5)
+    path = books.journal.path(books.journal.generation)
+    books.batch(20)
+    written = os.path.getsize(path)
+
+    with books.journal.batch() as records:
+        for _ in range(20):
+            books.step()
+        books.journal.flush()
+        assert os.path.getsize(path) == written
+        block = books.journal.commit(records)
+
+    assert block == (books.journal.generation, 2)
+    assert os.path.getsize(path) > written
+
+
+# A block whose batch didn't commit (it failed, or the engine stopped before it could) is
+# skipped, along with the changes it holds
+def test_uncommitted_block_is_skipped(tmp_path):
+    books = RandomBooks(str(tmp_path), 11)
+    persistence.writeSnapshot(
+        books.books, str(tmp_path), PARTITION, PARTITIONS, books.journal.generation
+    )
+    for _ in range(10):
+        books.batch(10)
+    before = state(books.books)
+
+    with books.journal.batch() as records:
+        for _ in range(20):
+            books.step()
+        books.journal.commit(records)
+
+    _, restored, _ = restore(str(tmp_path), books.committed)
+
+    assert state(restored) == before
+    assert state(restore(str(tmp_path))[1]) == state(books.books)
+
+
+def test_torn_last_record_is_ignored(tmp_path):
+    books = RandomBooks(str(tmp_path), 7)
+    persistence.writeSnapshot(
+        books.books, str(tmp_path), PARTITION, PARTITIONS, books.journal.generation
+    )
+    for _ in range(50):
+        books.step()
+    books.journal.flush()
+    before = state(books.books)
+
+    order = RestingOrder(
+        stock_tx_id=10_000,
+        user_id="z",
+        stock_id=1,
+        price=3,
+        quantity=1,
+        amount_sold=0,
+        seq=10_000,
+        order_type="LIMIT",
+    )
+    with books.journal.batch() as records:
+        books.books[False][1].add(order)
+        books.journal.commit(records)
+    path = books.journal.path(books.journal.generation)
+    os.truncate(path, os.path.getsize(path) - 3)
+
+    _, restored, index = restore(str(tmp_path))
+
+    assert state(restored) == before
+    assert 10_000 not in index
+
+
+def test_no_snapshot_for_this_layout_means_rebuild(tmp_path):
+    books = RandomBooks(str(tmp_path), 3)
+    for _ in range(20):
+        books.step()
+    persistence.writeSnapshot(books.books, str(tmp_path), PARTITION, 2, 0)
+
+    assert restore(str(tmp_path))[0] is None
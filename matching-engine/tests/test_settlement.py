@@ -0,0 +1,364 @@
+import asyncio
+import importlib
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from schemas.settlement import SettlementLeg, Settlements
+
+engineDbConnect = importlib.import_module("matching-engine.app.core.engineDbConnect")
+orderbook = importlib.import_module("matching-engine.app.core.orderbook")
+settlement = importlib.import_module("matching-engine.app.settlement")
+RestingOrder = orderbook.RestingOrder
+
+STOCK = 1
+SELLERS = ["s1", "s2", "s3"]
+
+
+async def seed(session):
+    await session.execute(
+        text(
+            "INSERT INTO stocks (stock_id, stock_name, current_price) VALUES (1, 'S', 0)"
+        )
+    )
+    for user_id in [*SELLERS, "buyer", "bidder"]:
+        await session.execute(
+            text(
+                "INSERT INTO users (id, user_name, name, password, salt) "
+                "VALUES (:u, :u, 'n', '', '')"
+            ),
+            {"u": user_id},
+        )
+        await session.execute(
+            text("INSERT INTO wallets (user_id, balance) VALUES (:u, 10000)"),
+            {"u": user_id},
+        )
+    for user_id in SELLERS:
+        await session.execute(
+            text(
+                "INSERT INTO stockportfolios (user_id, stock_id, quantity_owned) "
+                "VALUES (:u, 1, 100)"
+            ),
+            {"u": user_id},
+        )
+
+
+def restingOrder(user_id, price, quantity, is_buy=False):
+    return RestingOrder(
+        stock_tx_id=None,
+        user_id=user_id,
+        stock_id=STOCK,
+        price=price,
+        quantity=quantity,
+        amount_sold=0,
+        seq=0,
+        order_type="LIMIT",
+        is_buy=is_buy,
+    )
+
+
+def fillLeg(order, quantity, price):
+    order.amount_sold += quantity
+    return SettlementLeg(
+        user_id=order.user_id,
+        stock_id=STOCK,
+        stock_tx_id=order.stock_tx_id,
+        is_buy=order.is_buy,
+        order_type="LIMIT",
+        quantity=quantity,
+        price=price,
+        amount=price * quantity,
+        limit_price=order.price if order.is_buy else None,
+        completes=order.amount_sold == order.quantity,
+        matched_at=time.time(),
+    )
+
+
+# Places three sells and a limit buy, then makes the legs of a market buy and of the limit buy
+# crossing the book: a fill that completes a sell, partial fills, and a fill below the bid
+async def placeOrdersAndLegs(session):
+    sells = [restingOrder(user_id, 10 + n, 10) for n, user_id in enumerate(SELLERS)]
+    for sell in sells:
+        sell.stock_tx_id = await engineDbConnect.stockFromSeller(session, sell)
+    bid = restingOrder("bidder", 13, 8, is_buy=True)
+    bid.stock_tx_id = await engineDbConnect.fundsFromBuyer(session, bid)
+
+    legs = [fillLeg(sells[0], 10, 10), fillLeg(sells[1], 4, 11)]
+    legs.append(
+        SettlementLeg(
+            user_id="buyer",
+            stock_id=STOCK,
+            is_buy=True,
+            order_type="MARKET",
+            quantity=14,
+            price=144 // 14,
+            amount=144,
+            matched_at=time.time(),
+        )
+    )
+    legs += [fillLeg(sells[1], 6, 11), fillLeg(bid, 6, 11)]
+    legs += [fillLeg(sells[2], 2, 12), fillLeg(bid, 2, 12)]
+    return legs
+
+
+# What settling left behind, with the ids and time stamps the two ways may differ in left out
+async def outcome(session):
+    wallets = await session.execute(
+        text("SELECT user_id, balance FROM wallets ORDER BY user_id")
+    )
+    holdings = await session.execute(
+        text(
+            "SELECT user_id, stock_id, quantity_owned FROM stockportfolios "
+            "ORDER BY user_id, stock_id"
+        )
+    )
+    orders = await session.execute(
+        text(
+            "SELECT user_id, is_buy, order_status::text, quantity, "
+            "parent_stock_tx_id IS NULL, wallet_tx_id IS NULL FROM stocktransactions "
+            "ORDER BY 1, 2, 3, 4, 5, 6"
+        )
+    )
+    walletTxs = await session.execute(
+        text(
+            "SELECT user_id, is_debit, amount FROM wallettransactions ORDER BY 1, 2, 3"
+        )
+    )
+    return [r.all() for r in (wallets, holdings, orders, walletTxs)]
+
+
+async def settle(scratchDatabase, oneAtATime):
+    async with scratchDatabase() as engine:
+        async with engine.connect() as connection:
+            session = AsyncSession(bind=connection, expire_on_commit=False)
+            await seed(session)
+            legs = await placeOrdersAndLegs(session)
+            await session.flush()
+
+            if oneAtATime:
+                for leg in legs:
+                    async with session.begin_nested():
+                        await engineDbConnect.settleLeg(session, leg)
+            else:
+                await engineDbConnect.settleLegs(session, legs)
+            await session.flush()
+
+            result = await outcome(session)
+            await session.close()
+            return result
+
+
+def test_set_based_settlement_matches_one_leg_at_a_time(scratchDatabase):
+    together = asyncio.run(settle(scratchDatabase, oneAtATime=False))
+    oneByOne = asyncio.run(settle(scratchDatabase, oneAtATime=True))
+
+    assert together == oneByOne
+
+    wallets, holdings, orders, _ = together
+    assert dict(wallets) == {
+        # market buy paid when it matched, not at settlement
+        "buyer": 10000,
+        # reserved 8 * 13, refunded (13 - 11) * 6 + (13 - 12) * 2
+        "bidder": 10000 - 104 + 14,
+        "s1": 10000 + 100,
+        "s2": 10000 + 44 + 66,
+        "s3": 10000 + 24,
+    }
+    assert ("buyer", 1, 14) in holdings and ("bidder", 1, 8) in holdings
+    statuses = {(user, status) for user, _, status, _, parent, _ in orders if parent}
+    assert statuses >= {
+        ("s1", "COMPLETED"),
+        ("s2", "COMPLETED"),
+        ("bidder", "COMPLETED"),
+    }
+    assert ("s3", "PARTIALLY_COMPLETE") in statuses
+
+
+# A queue delivers at least once: legs settled already, delivered again together or one at a
+# time, or twice in one batch, change nothing the second time
+def test_legs_delivered_again_are_settled_once(scratchDatabase):
+    async def run():
+        async with scratchDatabase() as engine:
+            async with engine.connect() as connection:
+                session = AsyncSession(bind=connection, expire_on_commit=False)
+                await seed(session)
+                legs = await placeOrdersAndLegs(session)
+                await engineDbConnect.settleLegs(session, legs + legs[:2])
+                await session.flush()
+                once = await outcome(session)
+
+                await engineDbConnect.settleLegs(session, legs)
+                for leg in legs:
+                    async with session.begin_nested():
+                        await engineDbConnect.settleLeg(session, leg)
+                await session.flush()
+                again = await outcome(session)
+                await session.close()
+                return once, again
+
+    once, again = asyncio.run(run())
+    assert once == again
+    assert asyncio.run(settle(scratchDatabase, oneAtATime=False)) == once
+
+
+# A leg that can't be settled even on its own is set aside in failedsettlements with the rest
+# of its batch settled, so its message can be acked; delivered again, nothing changes
+def test_leg_that_fails_alone_is_recorded_not_dropped(scratchDatabase, monkeypatch):
+    async def run():
+        async with scratchDatabase() as engine:
+            monkeypatch.setattr(
+                settlement,
+                "async_session_maker",
+                async_sessionmaker(engine, expire_on_commit=False),
+            )
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                await seed(session)
+                legs = await placeOrdersAndLegs(session)
+                await session.commit()
+
+            ghost = legs[0].model_copy(update={"user_id": "ghost", "leg_id": "ghost"})
+            message = SimpleNamespace(
+                body=Settlements(legs=[*legs, ghost]).model_dump_json().encode()
+            )
+            await settlement.settleBatch([message])
+
+            async with AsyncSession(engine) as session:
+                settled = await outcome(session)
+            await settlement.settleBatch([message])
+
+            async with AsyncSession(engine) as session:
+                failed = await session.execute(
+                    text("SELECT leg_id, queue, leg, error FROM failedsettlements")
+                )
+                return settled, await outcome(session), failed.all()
+
+    settled, again, failed = asyncio.run(run())
+    assert again == settled
+    assert settled == asyncio.run(settle(scratchDatabase, oneAtATime=True))
+    assert len(failed) == 1
+    leg_id, queue, leg, error = failed[0]
+    assert leg_id == "ghost" and queue == settlement.settlement_queue(settlement.worker)
+    assert SettlementLeg.model_validate_json(leg).user_id == "ghost"
+    assert "No wallet found" in error
+
+
+# What a batch writes to the outbox is read back as it was, only by its own partition, until
+# it's deleted; nothing is written if the batch rolls back
+def test_settlement_outbox_keeps_legs_until_deleted(scratchDatabase, monkeypatch):
+    async def run():
+        async with scratchDatabase() as engine:
+            monkeypatch.setattr(
+                engineDbConnect,
+                "async_session_maker",
+                async_sessionmaker(engine, expire_on_commit=False),
+            )
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                await seed(session)
+                legs = await placeOrdersAndLegs(session)
+                byQueue = {"settlement-0": legs[:3], "settlement-1": legs[3:]}
+                written = await engineDbConnect.writeSettlementOutbox(
+                    session, 0, byQueue
+                )
+                await engineDbConnect.writeSettlementOutbox(session, 1, byQueue)
+                await session.commit()
+
+                await engineDbConnect.writeSettlementOutbox(session, 0, byQueue)
+                await session.rollback()
+
+            read = await engineDbConnect.getSettlementOutbox(0)
+            async with AsyncSession(engine) as session:
+                await engineDbConnect.deleteSettlementOutbox(session, [written[0][0]])
+                await session.commit()
+            left = await engineDbConnect.getSettlementOutbox(0)
+            return written, read, left
+
+    written, read, left = asyncio.run(run())
+    assert [queue for _, queue, _ in written] == ["settlement-0", "settlement-1"]
+    assert read == written
+    assert left == written[1:]
+
+
+# The engine's rebuild of its books from the database: the orders still open with what their
+# child fills sold, read across the time partitions, here with an order placed a month before
+# its fills
+def test_resting_orders_are_read_back_with_their_fills(scratchDatabase, monkeypatch):
+    async def run():
+        async with scratchDatabase() as engine:
+            monkeypatch.setattr(
+                engineDbConnect,
+                "async_session_maker",
+                async_sessionmaker(engine, expire_on_commit=False),
+            )
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                await seed(session)
+                legs = await placeOrdersAndLegs(session)
+                await engineDbConnect.settleLegs(session, legs)
+                await session.execute(
+                    text(
+                        "UPDATE stocktransactions "
+                        "SET time_stamp = time_stamp - interval '30 days' "
+                        "WHERE user_id = 's3' AND parent_stock_tx_id IS NULL"
+                    )
+                )
+                await session.commit()
+
+            owned = await engineDbConnect.getRestingOrders(1, 2)
+            other = await engineDbConnect.getRestingOrders(0, 2)
+            return [(o.user_id, o.quantity, sold) for o, sold in owned], other
+
+    owned, other = asyncio.run(run())
+    assert owned == [("s3", 10, 2)]
+    assert other == []
+
+
+# A rebuild of the books counts the fills that haven't settled, whichever partition's outbox
+# they are in or if they were set aside in failedsettlements. Settling deletes their outbox
+# rows, and the child transactions count instead.
+def test_resting_orders_count_fills_not_settled_yet(scratchDatabase, monkeypatch):
+    async def run():
+        async with scratchDatabase() as engine:
+            sessionMaker = async_sessionmaker(engine, expire_on_commit=False)
+            monkeypatch.setattr(engineDbConnect, "async_session_maker", sessionMaker)
+            monkeypatch.setattr(settlement, "async_session_maker", sessionMaker)
+            async with sessionMaker() as session:
+                await seed(session)
+                legs = await placeOrdersAndLegs(session)
+                # s3's fill of 2 couldn't be settled
+                failed, queued = legs[-2], legs[:-2] + legs[-1:]
+                await engineDbConnect.recordFailedSettlement(
+                    session, failed, "settlement-0", ValueError("x")
+                )
+                written = await engineDbConnect.writeSettlementOutbox(
+                    session, 1, {"settlement-0": queued}
+                )
+                await session.commit()
+
+            pending = await engineDbConnect.getRestingOrders(0, 1)
+            id, _, _ = written[0]
+            message = SimpleNamespace(
+                body=Settlements(legs=queued, outbox=[id]).model_dump_json().encode()
+            )
+            await settlement.settleBatch([message])
+            settled = await engineDbConnect.getRestingOrders(0, 1)
+            left = await engineDbConnect.getSettlementOutbox(1)
+            return pending, settled, left
+
+    pending, settled, left = asyncio.run(run())
+    # s1, s2 and the bid are completed by their pending fills
+    assert [(o.user_id, sold) for o, sold in pending] == [("s3", 2)]
+    assert [(o.user_id, sold) for o, sold in settled] == [("s3", 2)]
+    assert left == []
+
+
+def test_credit_to_a_missing_wallet_fails_the_batch(scratchDatabase):
+    async def run():
+        async with scratchDatabase() as engine:
+            async with AsyncSession(bind=engine) as session:
+                with pytest.raises(ValueError) as error:
+                    await engineDbConnect.creditWallets(session, {"nobody": 5})
+                return error.value.args
+
+    assert asyncio.run(run()) == (400, "No wallet found")
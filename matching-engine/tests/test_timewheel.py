@@ -0,0 +1,57 @@
+import importlib
+import random
+
+import pytest
+
+timewheel = importlib.import_module("matching-engine.app.core.timewheel")
+TimingWheel = timewheel.TimingWheel
+
+
+def test_due_items_come_back_on_their_tick():
+    wheel = TimingWheel(1000)
+    wheel.schedule(1003, "c")
+    wheel.schedule(1001, "a")
+    wheel.schedule(1001, "b")
+
+    assert wheel.advance(1000) == []
+    assert wheel.advance(1001) == ["a", "b"]
+    assert wheel.advance(1002) == []
+    assert wheel.advance(1010) == ["c"]
+    assert len(wheel) == 0
+
+
+def test_overdue_item_fires_on_the_next_tick():
+    wheel = TimingWheel(1000)
+    wheel.schedule(900, "late")
+
+    assert wheel.advance(1001) == ["late"]
+
+
+# Every item is handed back exactly once, by the advance that passes its due tick (the next
+# tick if it was already due), in due order. Two levels span 4096 ticks, so the later items
+# are parked beyond the wheel and placed again as it turns.
+@pytest.mark.parametrize("levels", [2, 4])
+@pytest.mark.parametrize("seed", range(5))
+def test_random_schedules_fire_on_time(levels, seed):
+    rng = random.Random(seed)
+    now = rng.randrange(1_000_000)
+    wheel = TimingWheel(now, levels)
+    due = {}
+    fired = set()
+
+    for item in range(2000):
+        if rng.random() < 0.5:
+            due[item] = max(now + rng.randrange(-10, 20_000), now + 1)
+            wheel.schedule(due[item], item)
+        else:
+            then = now
+            now += rng.choice([1, 1, 2, 63, 64, 65, 500, 4096])
+            came = wheel.advance(now)
+
+            assert [due[item] for item in came] == sorted(due[item] for item in came)
+            assert all(then < due[item] <= now for item in came)
+            assert fired.isdisjoint(came)
+            fired.update(came)
+            assert fired == {item for item, tick in due.items() if tick <= now}
+
+    assert len(wheel) == len(due) - len(fired)
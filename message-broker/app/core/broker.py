@@ -3,9 +3,21 @@ import asyncio
 import uuid
 from fastapi import HTTPException
 from schemas.common import SuccessResponse, RabbitError
+from schemas.partitioning import (
+    engine_partitions,
+    engine_queue,
+    engine_queues,
+    partition_for,
+    settlement_workers,
+    settlement_queues,
+)
+from schemas.settlement import SettlementQueueDepth
 from pydantic import ValidationError
+from .marketdata import marketDataSetup
 
 futures = {}
+partitions = engine_partitions()
+settlementWorkers = settlement_workers()
 
 
 # Takes data from the FastAPI get/post request and sends the rabbitmq message
@@ -14,15 +26,7 @@ futures = {}
 # content identifies the message once it's recieved by the service its headed to (STOCK_ORDER, CANCEL_ORDER...)
 # q_name is the name of the queue the message will be placed in (matching-engine, transaction...)
 async def sendRequest(x_user_data, body, content, q_name):
-    if not x_user_data:
-        raise HTTPException(status_code=400, detail="User data is missing in headers")
-
-    if x_user_data == "NO_AUTH":
-        user_id = ""
-        header_data = {}
-    else:
-        username, user_id = x_user_data.split("|")
-        header_data = {"user_id": user_id}
+    header_data = userHeaders(x_user_data)
 
     response = await rpcCall(
         body=body.encode(),
@@ -31,6 +35,85 @@ async def sendRequest(x_user_data, body, content, q_name):
         q_name=q_name,
     )
 
+    return parseResponse(response)
+
+
+# Same as sendRequest, but goes to the matching engine partition that owns stock_id
+async def sendEngineRequest(x_user_data, body, content, stock_id):
+    return await sendRequest(
+        x_user_data=x_user_data,
+        body=body,
+        content=content,
+        q_name=engine_queue(partition_for(stock_id, partitions)),
+    )
+
+
+# Sends the request to every matching engine partition and merges the data lists they reply with
+async def broadcastEngineRequest(x_user_data, body, content):
+    responses = await engineFanOut(x_user_data, body, content)
+
+    data = []
+    for response in responses:
+        data.extend(parseResponse(response).data or [])
+    return SuccessResponse(data=data)
+
+
+# The best ask of every stock with sells resting, from every partition, sorted by stock_name
+# descending as a single engine returns them
+async def getStockPrices():
+    prices = await broadcastEngineRequest(
+        x_user_data="NO_AUTH",
+        body="",
+        content="GET_PRICES",
+    )
+    prices.data.sort(key=lambda price: price["stock_name"], reverse=True)
+    return prices
+
+
+# Sends the request to every matching engine partition and returns the first success.
+# Used when the request doesn't say which stock it's for, so only one partition can handle it.
+# A 404 from one partition just means another partition owns the order.
+async def firstEngineRequest(x_user_data, body, content):
+    responses = await engineFanOut(x_user_data, body, content)
+
+    error = None
+    for response in responses:
+        if response.content_type == "SUCCESS":
+            return parseResponse(response)
+        reply = RabbitError.model_validate_json(response.body.decode())
+        if error is None or error.status_code == 404:
+            error = reply
+    raise HTTPException(status_code=error.status_code, detail=error.detail)
+
+
+async def engineFanOut(x_user_data, body, content):
+    header_data = userHeaders(x_user_data)
+
+    return await asyncio.gather(
+        *(
+            rpcCall(
+                body=body.encode(),
+                content=content,
+                header=header_data,
+                q_name=q_name,
+            )
+            for q_name in engine_queues(partitions)
+        )
+    )
+
+
+def userHeaders(x_user_data):
+    if not x_user_data:
+        raise HTTPException(status_code=400, detail="User data is missing in headers")
+
+    if x_user_data == "NO_AUTH":
+        return {}
+
+    username, user_id = x_user_data.split("|")
+    return {"user_id": user_id}
+
+
+def parseResponse(response):
     if response.content_type == "SUCCESS":
         return SuccessResponse.model_validate_json(response.body.decode())
 
@@ -51,8 +134,29 @@ async def broker_setup():
 
     await callback_queue.consume(processResponse)
 
-    await rabbitmq_channel.declare_queue("matching-engine", auto_delete=True)
+    for q_name in engine_queues(partitions):
+        await rabbitmq_channel.declare_queue(q_name, auto_delete=True)
     await rabbitmq_channel.declare_queue("transaction", auto_delete=True)
+    for q_name in settlement_queues(settlementWorkers):
+        await rabbitmq_channel.declare_queue(q_name, durable=True)
+
+    await marketDataSetup(rabbitmq_channel)
+
+
+# The messages waiting on each settlement queue. Redeclaring a queue with the arguments it was
+# declared with changes nothing and reports its current depth.
+async def settlementLag():
+    depths = []
+    for q_name in settlement_queues(settlementWorkers):
+        queue = await rabbitmq_channel.declare_queue(q_name, durable=True)
+        depths.append(
+            SettlementQueueDepth(
+                queue=q_name,
+                messages=queue.declaration_result.message_count,
+                consumers=queue.declaration_result.consumer_count,
+            )
+        )
+    return SuccessResponse(data=depths)
 
 
 async def broker_shutdown():
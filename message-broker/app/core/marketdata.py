@@ -0,0 +1,62 @@
+import aio_pika
+import asyncio
+from collections import deque
+from schemas.marketdata import MARKET_DATA_EXCHANGE, MarketData
+
+# most trades kept for a subscriber that isn't reading; older ones are dropped
+TRADE_BACKLOG = 1000
+
+subscriptions = set()
+
+
+# What one stream client is waiting to be sent.
+#
+# Prices are conflated: only the latest update per stock is kept, so a slow client skips
+# straight to the current price instead of working through every change it missed. Trades are
+# kept in order, up to TRADE_BACKLOG of them.
+class Subscription:
+    def __init__(self, stock_ids):
+        # None means every stock
+        self.stock_ids = set(stock_ids) if stock_ids else None
+        self.prices = {}
+        self.trades = deque(maxlen=TRADE_BACKLOG)
+        self.ready = asyncio.Event()
+
+    def wants(self, stock_id: int):
+        return self.stock_ids is None or stock_id in self.stock_ids
+
+    def offer(self, marketData: MarketData):
+        for price in marketData.prices:
+            if self.wants(price.stock_id):
+                self.prices[price.stock_id] = price
+                self.ready.set()
+        for trade in marketData.trades:
+            if self.wants(trade.stock_id):
+                self.trades.append(trade)
+                self.ready.set()
+
+    # Waits for updates and returns them as (event name, model) pairs, prices first
+    async def next(self):
+        await self.ready.wait()
+        self.ready.clear()
+
+        events = [("price", price) for price in self.prices.values()]
+        events.extend(("trade", trade) for trade in self.trades)
+        self.prices = {}
+        self.trades.clear()
+        return events
+
+
+async def marketDataSetup(channel):
+    exchange = await channel.declare_exchange(
+        MARKET_DATA_EXCHANGE, aio_pika.ExchangeType.FANOUT
+    )
+    queue = await channel.declare_queue(exclusive=True)
+    await queue.bind(exchange)
+    await queue.consume(processMarketData, no_ack=True)
+
+
+async def processMarketData(message):
+    marketData = MarketData.model_validate_json(message.body.decode())
+    for subscription in subscriptions:
+        subscription.offer(marketData)
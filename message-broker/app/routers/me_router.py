@@ -1,10 +1,24 @@
-from fastapi import APIRouter, Header, HTTPException
+import asyncio
+import json
+from typing import Literal, Optional
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from schemas.common import ErrorResponse, SuccessResponse, RabbitError
-from schemas.engine import StockOrder, CancelOrder
+from schemas.engine import (
+    StockOrder,
+    CancelOrder,
+    DepthRequest,
+    MAX_DEPTH_LEVELS,
+    RecentOrdersRequest,
+    CandlesRequest,
+)
 from ..core.broker import *
+from ..core.marketdata import Subscription, subscriptions
+
+# seconds between keepalive comments on an idle stream
+STREAM_KEEPALIVE = 15
 
 router = APIRouter()
-queue_name = "matching-engine"
 
 
 @router.post(
@@ -18,11 +32,11 @@ queue_name = "matching-engine"
     },
 )
 async def placeStockOrder(order: StockOrder, x_user_data: str = Header(None)):
-    return await sendRequest(
+    return await sendEngineRequest(
         x_user_data=x_user_data,
         body=order.model_dump_json(),
         content="STOCK_ORDER",
-        q_name=queue_name,
+        stock_id=order.stock_id,
     )
 
 
@@ -35,19 +49,158 @@ async def placeStockOrder(order: StockOrder, x_user_data: str = Header(None)):
     },
 )
 async def cancelStockOrder(order: CancelOrder, x_user_data: str = Header(None)):
-    return await sendRequest(
+    if order.stock_id is None:
+        return await firstEngineRequest(
+            x_user_data=x_user_data,
+            body=order.model_dump_json(),
+            content="CANCEL_ORDER",
+        )
+
+    return await sendEngineRequest(
         x_user_data=x_user_data,
         body=order.model_dump_json(),
         content="CANCEL_ORDER",
-        q_name=queue_name,
+        stock_id=order.stock_id,
     )
 
 
 @router.get("/getStockPrices")
 async def getStockPrice():
-    return await sendRequest(
+    return await getStockPrices()
+
+
+# The best <levels> price levels on both sides of a stock's book, with the quantity and number
+# of orders resting at each
+@router.get(
+    "/getStockDepth",
+    responses={
+        200: {"model": SuccessResponse},
+        400: {"model": ErrorResponse},
+    },
+)
+async def getStockDepth(
+    stock_id: int, levels: int = Query(10, ge=1, le=MAX_DEPTH_LEVELS)
+):
+    return await sendEngineRequest(
+        x_user_data="NO_AUTH",
+        body=DepthRequest(stock_id=stock_id, levels=levels).model_dump_json(),
+        content="GET_DEPTH",
+        stock_id=stock_id,
+    )
+
+
+# The caller's latest orders on a stock as the matching engine last saw them, newest first.
+# Only the engine's recent history is kept (ENGINE_HISTORY_SIZE orders per stock).
+@router.get(
+    "/getRecentOrders",
+    responses={
+        200: {"model": SuccessResponse},
+        400: {"model": ErrorResponse},
+    },
+)
+async def getRecentOrders(
+    stock_id: int,
+    limit: int = Query(20, ge=1, le=1000),
+    x_user_data: str = Header(None),
+):
+    return await sendEngineRequest(
+        x_user_data=x_user_data,
+        body=RecentOrdersRequest(stock_id=stock_id, limit=limit).model_dump_json(),
+        content="GET_RECENT_ORDERS",
+        stock_id=stock_id,
+    )
+
+
+# OHLCV candles of a stock's trades for 1s, 1m or 5m intervals, oldest first. Built in memory by
+# the matching engine from the trades since it started; intervals without trades are left out.
+@router.get(
+    "/getStockCandles",
+    responses={
+        200: {"model": SuccessResponse},
+        400: {"model": ErrorResponse},
+    },
+)
+async def getStockCandles(
+    stock_id: int,
+    interval: Literal["1s", "1m", "5m"] = "1m",
+    limit: int = Query(100, ge=1, le=1440),
+):
+    return await sendEngineRequest(
+        x_user_data="NO_AUTH",
+        body=CandlesRequest(
+            stock_id=stock_id, interval=interval, limit=limit
+        ).model_dump_json(),
+        content="GET_CANDLES",
+        stock_id=stock_id,
+    )
+
+
+# What each matching engine partition holds in memory against its container's limit
+@router.get("/getMemoryUsage")
+async def getMemoryUsage():
+    return await broadcastEngineRequest(
         x_user_data="NO_AUTH",
         body="",
-        content="GET_PRICES",
-        q_name=queue_name,
+        content="GET_MEMORY",
+    )
+
+
+# How many orders are waiting to be matched for each stock, busiest first within each matching
+# engine partition
+@router.get("/getStockQueueDepth")
+async def getStockQueueDepth():
+    return await broadcastEngineRequest(
+        x_user_data="NO_AUTH",
+        body="",
+        content="GET_QUEUE_DEPTH",
+    )
+
+
+# How many settlement messages each settlement worker has yet to take. Fills are settled in the
+# database behind the matching engine, so this is how far the database is behind the books.
+@router.get("/getSettlementLag")
+async def getSettlementLag():
+    return await settlementLag()
+
+
+# Server-sent events with best price changes ("price") and trades ("trade"), for the stocks
+# given as stock_id query parameters or for every stock if there are none. The stream opens
+# with the current prices, then pushes changes as the matching engines publish them; a client
+# that falls behind gets the latest price per stock rather than every change it missed.
+@router.get("/streamMarketData")
+async def streamMarketData(stock_id: Optional[list[int]] = Query(None)):
+    subscription = Subscription(stock_id)
+    subscriptions.add(subscription)
+
+    try:
+        current = await getStockPrices()
+    except Exception:
+        subscriptions.discard(subscription)
+        raise
+
+    async def events():
+        try:
+            for price in current.data:
+                if subscription.wants(price["stock_id"]):
+                    yield f"event: price\ndata: {json.dumps(price)}\n\n"
+
+            while True:
+                try:
+                    updates = await asyncio.wait_for(
+                        subscription.next(), STREAM_KEEPALIVE
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                for event, model in updates:
+                    yield f"event: {event}\ndata: {model.model_dump_json()}\n\n"
+        finally:
+            subscriptions.discard(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # stops nginx from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
@@ -147,9 +147,4 @@ async def add_stock_to_user(
 
 @router.get("/getStockPrices")
 async def getStockPrice():
-    return await sendRequest(
-        x_user_data="NO_AUTH",
-        body="",
-        content="GET_PRICES",
-        q_name="matching-engine",
-    )
+    return await getStockPrices()
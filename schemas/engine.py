@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Literal, Optional
 
@@ -8,45 +9,108 @@ class StockOrder(BaseModel):
     order_type: Literal["MARKET", "LIMIT"]
     quantity: int
     price: Optional[int] = None
+    # how long what doesn't fill straight away rests: until cancelled (GTC), until the market
+    # closes (DAY) or until expires_at (GTT). Market buys never rest.
+    time_in_force: Literal["GTC", "DAY", "GTT"] = "GTC"
+    expires_at: Optional[datetime] = None
 
 
-# TODO: child sell order
-
-
-class SellOrder(BaseModel):
+class BuyOrder(BaseModel):
     user_id: str
     stock_id: int
     quantity: int
-    price: int
     timestamp: str
+    price: Optional[int] = None
     order_type: Literal["MARKET", "LIMIT"]
-    stock_tx_id: Optional[int] = None
-    is_child: bool
-    amount_sold: int
 
-    def __eq__(self, other):
-        return self.price == other.price
 
-    def __lt__(self, other):
-        if self.price == other.price:
-            return self.timestamp < other.timestamp
-        return self.price < other.price
+class StockPrice(BaseModel):
+    stock_id: int
+    stock_name: str
+    current_price: int
+    quantity_available: int = 0
 
 
-class BuyOrder(BaseModel):
-    user_id: str
+class CancelOrder(BaseModel):
+    stock_tx_id: int
+    # lets the broker send the cancel straight to the engine that owns the stock
+    stock_id: Optional[int] = None
+
+
+# the most price levels a depth request can ask for on each side
+MAX_DEPTH_LEVELS = 100
+
+
+class DepthRequest(BaseModel):
     stock_id: int
+    levels: int = 10
+
+
+class DepthLevel(BaseModel):
+    price: int
     quantity: int
+    orders: int
+
+
+class StockDepth(BaseModel):
+    stock_id: int
+    # best price first on both sides
+    bids: list[DepthLevel]
+    asks: list[DepthLevel]
+
+
+# Orders waiting to be matched for one stock in a matching engine
+class StockQueueDepth(BaseModel):
+    stock_id: int
+    depth: int
+
+
+class RecentOrdersRequest(BaseModel):
+    stock_id: int
+    limit: int = 20
+
+
+# One of the caller's recent orders, as the matching engine saw it when it was placed or
+# cancelled
+class RecentOrder(BaseModel):
+    stock_tx_id: Optional[int]
+    is_buy: bool
+    order_type: str
+    # the limit price, or the average price paid for a market buy
+    price: Optional[int]
+    quantity: int
+    filled: int
+    status: str
     timestamp: str
-    price: Literal[0]
-    order_type: Literal["MARKET", "LIMIT"]
 
 
-class StockPrice(BaseModel):
+class CandlesRequest(BaseModel):
     stock_id: int
-    stock_name: str
-    current_price: int
+    interval: Literal["1s", "1m", "5m"] = "1m"
+    limit: int = 100
 
 
-class CancelOrder(BaseModel):
-    stock_tx_id: int
+# Trades in one interval. start is the interval's start in seconds since the epoch.
+class Candle(BaseModel):
+    start: int
+    open: int
+    high: int
+    low: int
+    close: int
+    volume: int
+
+
+# What a matching engine holds in memory, in bytes (estimated for the books, index, history and
+# ledger), against its container's limit
+class MemoryReport(BaseModel):
+    partition: int
+    resting_orders: int
+    books_bytes: int
+    index_bytes: int
+    history_orders: int
+    history_bytes: int
+    ledger_bytes: int
+    tape_bytes: int
+    process_rss_bytes: int
+    container_usage_bytes: Optional[int]
+    container_limit_bytes: Optional[int]
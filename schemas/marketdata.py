@@ -0,0 +1,24 @@
+from pydantic import BaseModel
+from typing import Optional
+
+# fanout exchange the matching engines publish MarketData to after every batch
+MARKET_DATA_EXCHANGE = "market-data"
+
+
+class PriceUpdate(BaseModel):
+    stock_id: int
+    # None once the stock has no sell volume left
+    current_price: Optional[int] = None
+    quantity_available: int = 0
+
+
+class Trade(BaseModel):
+    stock_id: int
+    price: int
+    quantity: int
+    timestamp: str
+
+
+class MarketData(BaseModel):
+    prices: list[PriceUpdate] = []
+    trades: list[Trade] = []
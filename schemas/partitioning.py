@@ -0,0 +1,63 @@
+import os
+import dotenv
+import zlib
+
+ENGINE_QUEUE = "matching-engine"
+
+
+def engine_partitions() -> int:
+    """Number of matching engine instances the stocks are split across"""
+    dotenv.load_dotenv(override=True)
+    return int(os.getenv("ENGINE_PARTITIONS") or 1)
+
+
+def engine_partition() -> int:
+    """Partition owned by this engine. Defaults to the swarm task slot, which starts at 1"""
+    dotenv.load_dotenv(override=True)
+    partition = os.getenv("ENGINE_PARTITION")
+    if partition is None:
+        return int(os.getenv("ENGINE_SLOT") or 1) - 1
+    return int(partition)
+
+
+def partition_for(stock_id: int, partitions: int) -> int:
+    return stock_id % partitions
+
+
+def engine_queue(partition: int) -> str:
+    return f"{ENGINE_QUEUE}-{partition}"
+
+
+def engine_queues(partitions: int) -> list[str]:
+    return [engine_queue(partition) for partition in range(partitions)]
+
+
+SETTLEMENT_QUEUE = "settlement"
+
+
+def settlement_workers() -> int:
+    """Number of settlement workers, each consuming its own settlement queue"""
+    dotenv.load_dotenv(override=True)
+    return int(os.getenv("SETTLEMENT_WORKERS") or 1)
+
+
+def settlement_worker() -> int:
+    """Queue consumed by this settlement worker. Defaults to the swarm task slot, which starts at 1"""
+    dotenv.load_dotenv(override=True)
+    worker = os.getenv("SETTLEMENT_WORKER")
+    if worker is None:
+        return int(os.getenv("SETTLEMENT_SLOT") or 1) - 1
+    return int(worker)
+
+
+def settlement_queue(worker: int) -> str:
+    return f"{SETTLEMENT_QUEUE}-{worker}"
+
+
+def settlement_queue_for(user_id: str, workers: int) -> str:
+    # crc32 rather than hash(), which changes between processes
+    return settlement_queue(zlib.crc32(user_id.encode()) % workers)
+
+
+def settlement_queues(workers: int) -> list[str]:
+    return [settlement_queue(worker) for worker in range(workers)]
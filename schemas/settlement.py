@@ -0,0 +1,44 @@
+import uuid
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
+
+
+# One account's side of a fill, queued by the matching engine for the settlement workers.
+#
+# A leg with no stock_tx_id is the buyer's side of a market buy: quantity and amount are the
+# totals over all of its fills, and its transaction is created when it settles. Every other leg
+# is one fill of a resting or incoming limit order.
+#
+# A queue may deliver a leg more than once, so each has an id of its own, made when it's matched
+# and carried with it, that the settlement workers record as they settle it (see settleLegs).
+class SettlementLeg(BaseModel):
+    leg_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    user_id: str
+    stock_id: int
+    stock_tx_id: Optional[int] = None
+    is_buy: bool
+    order_type: Literal["MARKET", "LIMIT"]
+    quantity: int
+    # price per share the fill traded at
+    price: int
+    # money that changes hands: price * quantity for a fill
+    amount: int
+    # the limit a buy paid for its shares up front, to refund fills that traded below it
+    limit_price: Optional[int] = None
+    # this fill leaves the order completely filled
+    completes: bool = False
+    # time.time() of the batch that matched it, to measure settlement lag
+    matched_at: float
+
+
+class Settlements(BaseModel):
+    legs: list[SettlementLeg]
+    # the settlementoutbox rows the legs were written to, deleted once they have settled
+    outbox: list[int] = []
+
+
+# How far one settlement worker is behind: the messages waiting on its queue
+class SettlementQueueDepth(BaseModel):
+    queue: str
+    messages: int
+    consumers: int
@@ -0,0 +1,204 @@
+# Checks that the wallet and stock transaction history queries read only the partitions their
+# window overlaps, and those from their covering (user_id, time_stamp) indexes alone: an Index
+# Only Scan with no heap fetches on every partition with rows in it, per EXPLAIN ANALYZE.
+# Exits 1 if either doesn't. Empty partitions (the ones made ahead) may be read any way, and
+# the partitions' rows may be sorted together, which the planner prefers while they're few.
+#
+# Builds its own partitioned tables in a scratch schema (dropped at the end), so it's safe to
+# point at any database the user can create schemas in. Run from the repo root:
+#   python3 -m transaction.explain_history
+#   python3 -m transaction.explain_history --url postgresql+asyncpg://admin:<password>@localhost:5433/day_trader
+#   python3 -m transaction.explain_history --users 2000 --rows 200
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from database import database_url
+from database.partitions import (
+    PARTITIONED_TABLES,
+    default_partition,
+    ensure_partitions,
+    partition_bounds,
+)
+from .transactions import wallet_transactions_query, stock_transactions_query
+
+SCHEMA = "explain_history_check"
+# days of transactions made, and how far back the queries look
+SPAN_DAYS = 60
+WINDOW_DAYS = 14
+
+
+# Every user gets <rows> stock transactions and a wallet transaction for each, spread over
+# SPAN_DAYS, so the user's rows are a small slice of each table
+SEED = [
+    "INSERT INTO users (id, user_name, name, password, salt) "
+    "SELECT 'user-' || u, 'user-' || u, 'n', '', '' FROM generate_series(1, :users) u",
+    "INSERT INTO stocks (stock_id, stock_name, current_price) VALUES (1, 'S', 10)",
+    "INSERT INTO stocktransactions (stock_id, order_status, is_buy, order_type, stock_price, "
+    "quantity, time_stamp, user_id) "
+    "SELECT 1, 'COMPLETED', r % 2 = 0, 'LIMIT', 10, 5, "
+    "now() - random() * interval '60 days', 'user-' || u "
+    "FROM generate_series(1, :users) u, generate_series(1, :rows) r",
+    "INSERT INTO wallettransactions (stock_tx_id, user_id, is_debit, amount, time_stamp) "
+    "SELECT stock_tx_id, user_id, is_buy, 50, time_stamp FROM stocktransactions",
+]
+
+
+def literal(query):
+    return str(
+        query.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def make_partitions(connection):
+    since = datetime.now(timezone.utc) - timedelta(days=SPAN_DAYS)
+    for table in PARTITIONED_TABLES:
+        ensure_partitions(connection, table, since)
+
+
+# The partitions of <table> a query for rows from <since> on has to read, all of them, and
+# the empty ones
+def partitions_needed(connection, table: str, since: datetime):
+    needed = {default_partition(table)}
+    everything = {default_partition(table)}
+    for name, _, upper in partition_bounds(connection, table):
+        everything.add(name)
+        if upper > since:
+            needed.add(name)
+    empty = connection.execute(
+        text(
+            "SELECT relname FROM pg_class WHERE relname = ANY(:names) AND reltuples = 0"
+        ),
+        {"names": list(everything)},
+    ).scalars()
+    return needed, everything, set(empty)
+
+
+# What's wrong with the plan of <query>, if anything, and the plan's summary. <index> is the
+# partitioned history index; the scans are of its copies on the partitions.
+async def check_plan(connection, query, table: str, index: str, since: datetime):
+    needed, everything, empty = await connection.run_sync(
+        partitions_needed, table, since
+    )
+    result = await connection.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:index)"
+        ),
+        {"index": index},
+    )
+    copies = set(result.scalars())
+
+    result = await connection.execute(
+        text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + literal(query))
+    )
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(plan_nodes(plan[0]["Plan"]))
+
+    problems = []
+    scans = [node for node in nodes if "Relation Name" in node]
+    for node in scans:
+        if node["Relation Name"] not in needed:
+            problems.append(f"{node['Relation Name']} read though outside the window")
+        if node["Relation Name"] in empty:
+            continue
+        if (
+            node["Node Type"] != "Index Only Scan"
+            or node.get("Index Name") not in copies
+        ):
+            problems.append(
+                f"{node['Node Type']} on {node['Relation Name']}"
+                + (f" using {node['Index Name']}" if "Index Name" in node else "")
+            )
+        elif node.get("Heap Fetches", 0):
+            problems.append(f"{node['Heap Fetches']} heap fetches")
+    if not scans:
+        problems.append("no scan of the table")
+
+    summary = " -> ".join(dict.fromkeys(node["Node Type"] for node in nodes))
+    return problems, (
+        f"{summary}, {len(scans)} of {len(everything)} partitions read, "
+        f"{plan[0]['Execution Time']:.2f}ms"
+    )
+
+
+async def run(args):
+    engine = create_async_engine(
+        args.url, connect_args={"server_settings": {"search_path": SCHEMA}}
+    )
+    failed = False
+
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        await connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        try:
+            await connection.run_sync(SQLModel.metadata.create_all)
+            await connection.run_sync(make_partitions)
+            for statement in SEED:
+                await connection.execute(
+                    text(statement), {"users": args.users, "rows": args.rows}
+                )
+            # index-only scans skip the heap only for pages the visibility map marks visible
+            for table in PARTITIONED_TABLES:
+                await connection.execute(text(f"VACUUM ANALYZE {table}"))
+
+            user_id = f"user-{args.users // 2}"
+            since = datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS)
+            for name, query, table in (
+                (
+                    "wallet transactions",
+                    wallet_transactions_query(user_id, since),
+                    "wallettransactions",
+                ),
+                (
+                    "stock transactions",
+                    stock_transactions_query(user_id, since),
+                    "stocktransactions",
+                ),
+            ):
+                problems, summary = await check_plan(
+                    connection, query, table, f"ix_{table}_user_id_time_stamp", since
+                )
+                if problems:
+                    failed = True
+                    print(f"{name}: FAILED ({', '.join(problems)}): {summary}")
+                else:
+                    print(f"{name}: pruned and index-only: {summary}")
+        finally:
+            await connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+    await engine.dispose()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url", default=os.getenv("EXPLAIN_DATABASE_URL") or database_url()
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rows", type=int, default=100)
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(run(args)) else 0)
+
+
+if __name__ == "__main__":
+    main()
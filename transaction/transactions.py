@@ -4,9 +4,11 @@ from fastapi import FastAPI, Header, HTTPException, Depends
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import RedirectResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
+from sqlalchemy import update
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 import asyncio
+from datetime import datetime, timedelta, timezone
 from database import (
     Wallets,
     WalletTransactions,
@@ -24,6 +26,10 @@ from .db import get_session, async_session_maker
 dotenv.load_dotenv(override=True)
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
+# days back the transaction histories go; 0, the default, returns all of it. Setting it lets
+# Postgres skip the transaction tables' older partitions (see database/partitions.py), but
+# leaves older transactions out of the histories.
+HISTORY_DAYS = int(os.getenv("TRANSACTION_HISTORY_DAYS") or 0)
 
 cache = RedisClient()
 
@@ -60,6 +66,31 @@ async def get_wallet_balance(user_id: str):
         return SuccessResponse(data={"balance": wallet.balance})
 
 
+# Where the transaction histories start, None for no limit
+def history_since():
+    if not HISTORY_DAYS:
+        return None
+    return datetime.now(timezone.utc) - timedelta(days=HISTORY_DAYS)
+
+
+# A user's wallet transactions since <since>, oldest first. Only the partitions from <since> on
+# are read, and from their covering (user_id, time_stamp) indexes alone (see
+# transaction/explain_history.py).
+def wallet_transactions_query(user_id: str, since: datetime = None):
+    statement = select(WalletTransactions).where(WalletTransactions.user_id == user_id)
+    if since is not None:
+        statement = statement.where(WalletTransactions.time_stamp >= since)
+    return statement.order_by(WalletTransactions.time_stamp)
+
+
+# A user's stock transactions since <since>, oldest first, likewise
+def stock_transactions_query(user_id: str, since: datetime = None):
+    statement = select(StockTransactions).where(StockTransactions.user_id == user_id)
+    if since is not None:
+        statement = statement.where(StockTransactions.time_stamp >= since)
+    return statement.order_by(StockTransactions.time_stamp)
+
+
 async def get_wallet_transactions(user_id: str):
     async with async_session_maker() as session:
         cache_hit = cache.get(f"{CacheName.WALLET_TX}:{user_id}")
@@ -68,16 +99,9 @@ async def get_wallet_transactions(user_id: str):
 
         async with session.begin():
             print("Cache MISS in get wallet transactions")
-            statement = (
-                select(WalletTransactions)
-                .join(
-                    StockTransactions,
-                    WalletTransactions.stock_tx_id == StockTransactions.stock_tx_id,
-                )
-                .where(WalletTransactions.user_id == user_id)
-                .order_by(WalletTransactions.time_stamp)
+            result = await session.execute(
+                wallet_transactions_query(user_id, history_since())
             )
-            result = await session.execute(statement)
             wallet_transactions = result.scalars().all()
 
         return SuccessResponse(
@@ -93,20 +117,21 @@ async def add_money_to_wallet(
         if req.amount <= 0:
             raise ValueError(400, "Amount must be greater than 0")
 
+        # one conditional UPDATE, so concurrent deposits and trades can't overwrite each
+        # other's balance
         async with session.begin():
-            statement = select(Wallets).where(Wallets.user_id == user_id)
-            result = await session.execute(statement)
-            wallet = result.scalar_one_or_none()
+            result = await session.execute(
+                update(Wallets)
+                .where(Wallets.user_id == user_id)
+                .values(balance=Wallets.balance + req.amount)
+                .returning(Wallets.balance)
+            )
+            balance = result.scalar_one_or_none()
 
-        if not wallet:
+        if balance is None:
             raise ValueError(404, "Wallet not found")
 
-        wallet.balance += req.amount
-
-        session.add(wallet)
-        await session.commit()
-
-        cache.set(f"{CacheName.WALLETS}:{user_id}", {"balance": wallet.balance})
+        cache.set(f"{CacheName.WALLETS}:{user_id}", {"balance": balance})
         return SuccessResponse()
 
 
@@ -154,12 +179,9 @@ async def get_stock_transactions(user_id: str):
 
         async with session.begin():
             print("Cache MISS in get stock transactions")
-            statement = (
-                select(StockTransactions)
-                .where(StockTransactions.user_id == user_id)
-                .order_by(StockTransactions.time_stamp)
+            result = await session.execute(
+                stock_transactions_query(user_id, history_since())
             )
-            result = await session.execute(statement)
             stock_transactions = result.scalars().all()
 
         return SuccessResponse(data=stock_transactions)